@@ -9,22 +9,30 @@ exp_coeff = extractexpDecayCoeff()
 cubic_bounds = extractCubicBounds()
 
 # START NEW PERMEABILITY
-def RelativePermeability(subdomain, u, uhat):
+def SteelRelativePermeability(u, uhat):
+    """
+    The nonlinear relative permeability of the electrical steel
+    """
     gradu = gradx(u,uhat)
-    if subdomain == 1 or subdomain == 2: # Electrical/Silicon/Laminated Steel
-        B = as_vector([gradu[1], -gradu[0]])
-        norm_B = sqrt(dot(B, B) + DOLFIN_EPS)
-
-        mu = conditional(
-            lt(norm_B, cubic_bounds[0]),
-            linearPortion(norm_B),
-            conditional(
-                lt(norm_B, cubic_bounds[1]),
-                cubicPortion(norm_B),
-                (exp_coeff[0] * exp(exp_coeff[1]*norm_B + exp_coeff[2]) + 1)
-            )
+    B = as_vector([gradu[1], -gradu[0]])
+    norm_B = sqrt(dot(B, B) + DOLFIN_EPS)
+
+    mu = conditional(
+        lt(norm_B, cubic_bounds[0]),
+        linearPortion(norm_B),
+        conditional(
+            lt(norm_B, cubic_bounds[1]),
+            cubicPortion(norm_B),
+            (exp_coeff[0] * exp(exp_coeff[1]*norm_B + exp_coeff[2]) + 1)
         )
-    elif subdomain >= 3 and subdomain <= 14: # NEODYMIUM
+    )
+    return mu
+
+def LinearRelativePermeability(subdomain):
+    """
+    The constant relative permeability of the subdomains other than steel
+    """
+    if subdomain >= 3 and subdomain <= 14: # NEODYMIUM
         mu = 1.05
     elif subdomain >= 15 and subdomain <= 50: # COPPER
         mu = 1.00
@@ -33,29 +41,109 @@ def RelativePermeability(subdomain, u, uhat):
     elif subdomain >= 52: # AIR
         mu = 1.00
     return mu
+
+def RelativePermeability(subdomain, u, uhat):
+    if subdomain == 1 or subdomain == 2: # Electrical/Silicon/Laminated Steel
+        mu = SteelRelativePermeability(u, uhat)
+    else:
+        mu = LinearRelativePermeability(subdomain)
+    return mu
 # END NEW PERMEABILITY
 
+def createSubdomainFields(subdomains_mf, p, s):
+    """
+    Turn the subdomain-tagged material data of the motor into DG0 fields,
+    so that the EM residual is a handful of integrals over all of the
+    cells instead of one integral per subdomain:
+    - `steel`: indicator of the nonlinear (steel) subdomains
+    - `inv_mu`: inverse relative permeability of the other subdomains
+    - `magnet_cos`, `magnet_sin`: signed magnetization direction
+    - `phase_A`, `phase_B`, `phase_C`: signs of the phase currents
+    """
+    num_components = 4 * 3 * p + 2 * s
+    base_magnet_dir = 2 * np.pi / p / 2
+    magnet_sweep    = 2 * np.pi / p
+    magnet_index_start = 2 + 1
+    stator_winding_index_start = p + 2 + 1
+    coils_per_pole = 3
+
+    def inv_mu(subdomain):
+        if subdomain < 3 or subdomain > num_components:
+            return None
+        return 1./LinearRelativePermeability(subdomain)
+
+    def magnet_dir(subdomain, func):
+        i = subdomain - magnet_index_start
+        if i < 0 or i >= p:
+            return None
+        return (-1)**(i) * func(base_magnet_dir + i * magnet_sweep)
+
+    def phase(subdomain, name):
+        # the coils of each pole are ordered as phases B, A, C
+        j = subdomain - stator_winding_index_start
+        if j < 0 or j >= coils_per_pole * p:
+            return None
+        i, k = divmod(j, coils_per_pole)
+        if ['B','A','C'][k] != name:
+            return None
+        return (-1)**(i) if name == 'A' else (-1)**(i+1)
+
+    return dict(
+        steel=createSubdomainIndicator(subdomains_mf, [1,2]),
+        inv_mu=createSubdomainFunction(subdomains_mf, inv_mu),
+        magnet_cos=createSubdomainFunction(subdomains_mf,
+                                lambda i: magnet_dir(i, np.cos)),
+        magnet_sin=createSubdomainFunction(subdomains_mf,
+                                lambda i: magnet_dir(i, np.sin)),
+        phase_A=createSubdomainFunction(subdomains_mf,
+                                lambda i: phase(i, 'A')),
+        phase_B=createSubdomainFunction(subdomains_mf,
+                                lambda i: phase(i, 'B')),
+        phase_C=createSubdomainFunction(subdomains_mf,
+                                lambda i: phase(i, 'C')),
+    )
+
 def compute_i_abc(iq, angle=0.0):
     i_abc = as_vector([
-        iq * np.sin(angle),
-        iq * np.sin(angle - 2*np.pi/3),
-        iq * np.sin(angle + 2*np.pi/3),
+        iq * ufl.sin(angle),
+        iq * ufl.sin(angle - 2*np.pi/3),
+        iq * ufl.sin(angle + 2*np.pi/3),
     ])
     return i_abc
 
-def JS(v,uhat,iq,p,s,Hc,angle):
+def JS(v,uhat,iq,p,s,Hc,angle,fields=None):
     """
     The variational form for the source term (current) of the
-    Maxwell equation
+    Maxwell equation; with the subdomain `fields` from
+    `createSubdomainFields`, the magnet and coil sources are each
+    a single integral
     """
     Jm = 0.
     gradv = gradx(v,uhat)
+    if fields is not None:
+        curl_v = as_vector([gradv[1],-gradv[0]])
+        theta = angle*2/p
+        H = Hc*as_vector([
+            fields['magnet_cos']*ufl.cos(theta)
+                - fields['magnet_sin']*ufl.sin(theta),
+            fields['magnet_sin']*ufl.cos(theta)
+                + fields['magnet_cos']*ufl.sin(theta),
+        ])
+        Jm = inner(H,curl_v)* J(uhat) *dx
+
+        i_abc = compute_i_abc(iq, angle)
+        JA, JB, JC = i_abc[0] + DOLFIN_EPS, i_abc[1] + DOLFIN_EPS, i_abc[2] + DOLFIN_EPS
+        current = (JA*fields['phase_A'] + JB*fields['phase_B']
+                    + JC*fields['phase_C'])
+        Jw = current * v * J(uhat) * dx
+        return Jm + Jw
+
     base_magnet_dir = 2 * np.pi / p / 2
     magnet_sweep    = 2 * np.pi / p
     for i in range(p):
         flux_angle = base_magnet_dir + i * magnet_sweep
-        Hx = (-1)**(i) * Hc * np.cos(flux_angle + angle*2/p)
-        Hy = (-1)**(i) * Hc * np.sin(flux_angle + angle*2/p)
+        Hx = (-1)**(i) * Hc * ufl.cos(flux_angle + angle*2/p)
+        Hy = (-1)**(i) * Hc * ufl.sin(flux_angle + angle*2/p)
 
         H = as_vector([Hx, Hy])
 
@@ -88,24 +176,34 @@ def JS(v,uhat,iq,p,s,Hc,angle):
 
 
 def pdeResEM(u,v,uhat,iq,dx,p,s,Hc,vacuum_perm,angle,
-                g=None,nitsche=False, sym=False, overpenalty=False,ds_=ds):
+                g=None,nitsche=False, sym=False, overpenalty=False,ds_=ds,
+                beta=1e4, fields=None, load_factor=1.):
     """
-    The variational form of the PDE residual for the electromagnetic problem
+    The variational form of the PDE residual for the electromagnetic problem;
+    `iq`, `Hc`, `vacuum_perm`, `angle` and `beta` can be given as the
+    Constant parameters of FEA to reuse the compiled forms, and the
+    subdomain `fields` from `createSubdomainFields` group the
+    per-subdomain integrals; the current source is scaled by
+    `load_factor` for the incremental solves
     """
     res = 0.
     gradu = gradx(u,uhat)
     gradv = gradx(v,uhat)
 
-    num_components = 4 * 3 * p + 2 * s
-    for i in range(num_components):
-        res += 1./vacuum_perm*(1/RelativePermeability(i + 1, u, uhat))\
-                *dot(gradu,gradv)*J(uhat)*dx(i + 1)
-    res -= JS(v,uhat,iq,p,s,Hc,angle)
+    if fields is not None:
+        inv_mu = (fields['steel']/SteelRelativePermeability(u, uhat)
+                    + fields['inv_mu'])
+        res += 1./vacuum_perm*inv_mu*dot(gradu,gradv)*J(uhat)*dx
+    else:
+        num_components = 4 * 3 * p + 2 * s
+        for i in range(num_components):
+            res += 1./vacuum_perm*(1/RelativePermeability(i + 1, u, uhat))\
+                    *dot(gradu,gradv)*J(uhat)*dx(i + 1)
+    res -= load_factor*JS(v,uhat,iq,p,s,Hc,angle,fields=fields)
 
     mesh = u.function_space.mesh
     boundary_res = 0.
     if nitsche is True:
-        beta = 1e4
         sgn = 1.0
         if sym is not True:
             sgn = -1.0
@@ -126,10 +126,6 @@ def getDisplacementSteps(uhat, edge_deltas):
     increment_deltas = edge_deltas/STEPS
     return STEPS, increment_deltas
 
-def advance(func_old,increment_deltas):
-    func_old.vector[edge_indices.astype(np.int32)] += \
-                    increment_deltas[edge_indices.astype(np.int32)]
-
 def solveIncremental(res,func,bc,report=False):
     vec = np.copy(input_function_mm.vector.getArray())
     nnz_ind = np.nonzero(vec)[0]
@@ -140,22 +136,26 @@ def solveIncremental(res,func,bc,report=False):
                                                 relative_edge_deltas)
 
 
-    snes_solver = SNESSolver(res, func, bc, report=report)
-    func_old.vector[:] = func.vector
+    snes_solver = fea_mm.getNonlinearSolver(res, func, bc)
+    start = np.copy(func.vector.getArray())
+    edge_deltas = np.zeros_like(start)
+    edge_deltas[edge_indices.astype(np.int32)] = \
+                    relative_edge_deltas[edge_indices.astype(np.int32)]
+
+    def setEdgeDeltas(load_factor):
+        setFuncArray(func_old, start + load_factor*edge_deltas)
 
-    # Incrementally set the BCs to increase to `edge_deltas`
+    # Incrementally set the BCs to increase to `edge_deltas`, starting
+    # with the step from the mesh size
     if report == True:
         print(80*"=")
-        print(' FEA: total steps for mesh motion:', STEPS)
+        print(' FEA: initial steps for mesh motion:', STEPS)
         print(80*"=")
-    for i in range(STEPS):
-        if report == True:
-            print(80*"=")
-            print("  FEA: Step "+str(i+1)+"/"+str(STEPS)+" of mesh movement")
-            print(80*"=")
-        advance(func_old,increment_deltas)
-        snes_solver.solve(None, func.vector)
+    converged, _ = solveContinuation(snes_solver, func, setEdgeDeltas,
+                        initial_step=1./STEPS, report=report)
     input_function_mm.vector.setArray(vec)
+    if not converged:
+        raise RuntimeError('the mesh motion did not converge')
     if report == True:
         print(80*"=")
         print(' FEA: L2 error of the mesh motion on the edges:',
@@ -215,6 +215,18 @@ fea_em.PDE_SOLVER = 'SNES'
 fea_em.REPORT = False
 fea_em.record = True
 
+# Runtime parameters of the electromagnetic forms; changing their values
+# for new rotor angles or currents reuses the compiled forms
+iq = fea_em.add_parameter('iq', iq)
+angle = fea_em.add_parameter('angle', angle)
+Hc = fea_em.add_parameter('Hc', Hc)
+vacuum_perm = fea_em.add_parameter('vacuum_perm', vacuum_perm)
+beta_em = fea_em.add_parameter('beta', 1e4)
+# Scaling of the current source for the incremental solves
+load_factor_em = fea_em.add_parameter('load_factor', 1.)
+# DG0 fields of the subdomain-tagged material data
+subdomain_fields = pde.createSubdomainFields(subdomains_mf, p, s)
+
 # Add input to the PDE problem: the inputs as the previous states
 
 # Add state to the PDE problem:
@@ -230,22 +242,19 @@ v_em = TestFunction(state_function_space_em)
 ############### much slower, but more accurate ##########################
 def solveIncrementalEM(res,func,bc,report=False):
     STEPS = 5
-    # Incrementally set the BCs to increase to `edge_deltas`
     if report == True:
         print(80*"=")
-        print(' FEA: total steps for electromagnetic solve:', STEPS)
+        print(' FEA: initial steps for electromagnetic solve:', STEPS)
         print(80*"=")
-    JS_scaler = 1./STEPS
-    res += pde.JS(v_em,state_function_mm,iq,p,s,Hc,angle)
-    for i in range(STEPS):
-        if report == True:
-            print(80*"=")
-            print("  FEA: Step "+str(i+1)+"/"+str(STEPS)+" of electromagnetic solve")
-            print(80*"=")
-        res -= JS_scaler*pde.JS(v_em,state_function_mm,iq,p,s,Hc,angle)
-        # print(np.linalg.norm(getFuncArray(func)))
-        snes_solver = SNESSolver(res, func, bc, report=report)
-        snes_solver.solve(None, func.vector)
+    # The current source of `res` is ramped up through its load factor,
+    # so one SNES solver serves all of the steps and solves
+    snes_solver = fea_em.getNonlinearSolver(res, func, bc)
+    converged, _ = solveContinuation(snes_solver, func, load_factor_em,
+                        initial_step=1./STEPS, report=report)
+    # The derivatives are evaluated at the full load
+    fea_em.set_parameter('load_factor', 1.)
+    if not converged:
+        raise RuntimeError('the electromagnetic solve did not converge')
 
 fea_em.custom_solve = solveIncrementalEM
 
@@ -275,7 +284,9 @@ ubc_em = Function(state_function_space_em)
 ubc_em.vector.set(0.0)
 residual_form_em = pde.pdeResEM(state_function_em,v_em,state_function_mm,
                         iq,dx,p,s,Hc,vacuum_perm,angle,
-                        g=ubc_em,nitsche=True, sym=True, overpenalty=False,ds_=ds)
+                        g=ubc_em,nitsche=True, sym=True, overpenalty=False,ds_=ds,
+                        beta=beta_em, fields=subdomain_fields,
+                        load_factor=load_factor_em)
 
 # Add output to the PDE problem:
 output_name_1 = 'B_influence_eddy_current'
@@ -9,6 +9,8 @@ class FEAModel(Model):
     def define(self):
         self.fea_list = fea_list = self.parameters['fea']
         for fea in fea_list:
+            # Compile all of the forms ahead of the first run
+            fea.precompile()
             for state_name in fea.states_dict:
                 arg_name_list_state = fea.states_dict[state_name]['arguments']
                 state_model = StateModel(fea=fea,
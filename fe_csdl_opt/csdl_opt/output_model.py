@@ -53,6 +53,7 @@ class OutputOperation(CustomExplicitOperation):
             arg = args_dict[arg_name]
             self.add_input(arg_name,
                             shape=(arg['shape'],),)
+        self.fea.precompile()
         self.output = self.fea.outputs_dict[output_name]
         self.output_size = self.output['shape']
         # for field output
@@ -62,14 +63,30 @@ class OutputOperation(CustomExplicitOperation):
             self.output_dim = 0
         self.add_output(output_name,
                         shape=(self.output_size,))
-        self.declare_derivatives('*', '*')
+
+        # The partials of the field outputs are declared sparse with the
+        # sparsity patterns of the assembled partial derivative matrices
+        self.partial_mats = dict()
+        for arg_name, partial in zip(self.output['arguments'],
+                                    self.output['partials_compiled']):
+            if isinstance(self.args_dict[arg_name]['function'], Constant):
+                self.declare_derivatives(output_name, arg_name)
+            elif self.output_dim == 1:
+                partial_mat = assembleMatrix(partial)
+                rows, cols = getCSRPattern(partial_mat)
+                self.partial_mats[arg_name] = partial_mat
+                self.declare_derivatives(output_name, arg_name,
+                                        rows=rows, cols=cols)
+            else:
+                self.declare_derivatives(output_name, arg_name)
 
     def compute(self, inputs, outputs):
         for arg_name in inputs:
             arg = self.args_dict[arg_name]
             update(arg['function'], inputs[arg_name])
 
-        outputs[self.output_name] = np.array(assemble(self.output['form'],
+        outputs[self.output_name] = np.array(assemble(
+                                        self.output['form_compiled'],
                                         dim=self.output_dim))
 
     def compute_derivatives(self, inputs, derivatives):
@@ -77,9 +94,20 @@ class OutputOperation(CustomExplicitOperation):
             arg = self.args_dict[arg_name]
             update(arg['function'], inputs[arg_name])
 
-        for arg_name in self.args_dict:
-            derivatives[self.output_name,arg_name] = assemble(
-                                    computePartials(
-                                        self.output['form'],
-                                        self.args_dict[arg_name]['function']),
-                                    dim=self.output_dim+1)
+        for arg_name, partial in zip(self.output['arguments'],
+                                    self.output['partials_compiled']):
+            if isinstance(self.args_dict[arg_name]['function'], Constant):
+                # the partial w.r.t. the scalar parameter input has the
+                # same rank as the output form
+                derivatives[self.output_name,arg_name] = np.reshape(
+                                    assemble(partial, dim=self.output_dim),
+                                    (self.output_size, 1))
+            elif self.output_dim == 1:
+                partial_mat = assembleMatrix(partial,
+                                        A=self.partial_mats[arg_name])
+                derivatives[self.output_name,arg_name] = getCSRValues(
+                                                            partial_mat)
+            else:
+                derivatives[self.output_name,arg_name] = assemble(
+                                        partial,
+                                        dim=self.output_dim+1)
@@ -60,12 +60,74 @@ class StateOperation(CustomImplicitOperation):
             self.add_input(arg_name,
                             shape=(arg['shape'],),)
 
+        self.fea.precompile()
         self.state = self.fea.states_dict[state_name]
         self.add_output(state_name,
                         shape=(self.state['shape'],),)
-        self.declare_derivatives('*', '*')
         self.bcs = self.fea.bc
 
+        # Allocate the matrices and vectors for the derivative assembly
+        # once from the sparsity patterns of the forms; they are zeroed
+        # and reassembled in place in `compute_derivatives`
+        self.dRdu = assembleMatrix(self.state['dR_du_compiled'])
+        self.A = self.dRdu.duplicate()
+        attachNearNullspace(self.A, self.state['function_space'],
+                            self.state['solver'])
+        self.dR_vec = self.dRdu.createVecLeft()
+        self.du_vec = self.dRdu.createVecRight()
+        # Declare the partials with the sparsity patterns of dR/du and dR/df;
+        # a matrix-free state declares none of them, and all of its
+        # derivatives go through the jacvec products
+        self.matrix_free = self.state['matrix_free']
+        if not self.matrix_free:
+            rows, cols = getCSRPattern(self.dRdu)
+            self.declare_derivatives(state_name, state_name,
+                                    rows=rows, cols=cols)
+        self.dRdf_dict = dict()
+        for arg_name, dR_df in zip(self.state['arguments'],
+                                    self.state['dR_df_compiled_list']):
+            if isinstance(args_dict[arg_name]['function'], Constant):
+                # dR/df is a dense column for the scalar parameter input
+                if not self.matrix_free:
+                    self.declare_derivatives(state_name, arg_name)
+                self.dRdf_dict[arg_name] = dict(
+                    dRdf=assembleVector(dR_df),
+                    constant=True)
+                continue
+            if self.matrix_free:
+                # dR/df only enters through the jacvec products, which are
+                # assembled from the action forms
+                self.dRdf_dict[arg_name] = dict(constant=False)
+                continue
+            dRdf = assembleMatrix(dR_df)
+            rows, cols = getCSRPattern(dRdf)
+            self.declare_derivatives(state_name, arg_name,
+                                    rows=rows, cols=cols)
+            self.dRdf_dict[arg_name] = dict(
+                dRdf=dRdf,
+                df=createFunction(args_dict[arg_name]['function']),
+                df_vec=dRdf.createVecRight(),
+                constant=False)
+        self.dR = self.state['d_residual']
+        self.du = self.state['d_state']
+        # One linear solver per state, so that every forward and adjoint
+        # solve of a linearization reuses the same factorization; small
+        # serial problems use the SciPy sparse direct solver instead
+        solver = self.state['solver'] or dict()
+        self.newton_linearization = None
+        self.tangent = None
+        self.history = None
+        if self.fea.STATE_HISTORY_MEMORY > 0:
+            self.history = StateHistory(self.fea.STATE_HISTORY_MEMORY)
+        self.linear_solver = createLinearSolver(self.A,
+                                options=self.state['solver'],
+                                prefix=self.state['options_prefix']+'adj_',
+                                function_space=self.state['function_space'],
+                                warm_start=solver.get('warm_start', False),
+                                max_pc_lag=solver.get('max_pc_lag', 0),
+                                pc_rebuild_iterations=solver.get(
+                                            'pc_rebuild_iterations', 50))
+
     def evaluate_residuals(self, inputs, outputs, residuals):
         if self.debug_mode == True:
             print(str(self.state_name)+"="*40)
@@ -76,7 +138,8 @@ class StateOperation(CustomImplicitOperation):
             arg = self.args_dict[arg_name]
             update(arg['function'], inputs[arg_name])
         update(self.state['function'], outputs[self.state_name])
-        residuals[self.state_name] = assembleVector(self.state['residual_form'])
+        residuals[self.state_name] = assembleVector(
+                                        self.state['residual_compiled'])
 
 
     def solve_residual_equations(self, inputs, outputs):
@@ -89,58 +152,194 @@ class StateOperation(CustomImplicitOperation):
         for arg_name in inputs:
             arg = self.args_dict[arg_name]
             update(arg['function'], inputs[arg_name])
-            if self.fea.record:
+            if self.fea.record and arg['recorder'] is not None:
                 arg['recorder'].write_function(arg['function'],
                                                 self.fea.opt_iter)
-        self.fea.solve(self.state['residual_form'],
+        if self.history is not None:
+            # Start from the state of the closest solved design
+            design = self.getDesignVector(inputs)
+            initial_guess = self.history.nearest(design)
+            if initial_guess is not None:
+                update(self.state['function'], initial_guess)
+        if self.fea.TANGENT_PREDICTOR:
+            self.applyPredictor(inputs)
+        newton_ksp = self.fea.solve(self.state['residual_form'],
                         self.state['function'],
-                        self.bcs)
+                        self.bcs,
+                        options=self.state['solver'],
+                        prefix=self.state['options_prefix'],
+                        linear=self.state['linear'])
 
         outputs[self.state_name] = getFuncArray(self.state['function'])
+        # Keep the last Newton linearization for the derivative solves
+        # at this solution
+        self.newton_linearization = None
+        if newton_ksp is not None:
+            self.newton_linearization = dict(
+                ksp=newton_ksp,
+                inputs={arg_name: np.array(inputs[arg_name])
+                            for arg_name in inputs},
+                state=np.array(outputs[self.state_name]))
+        if self.history is not None:
+            self.history.add(design, outputs[self.state_name])
         if self.fea.record:
             self.state['recorder'].write_function(self.state['function'],
                                                     self.fea.opt_iter)
 
+    def predictState(self, inputs):
+        """
+        Predict the state at `inputs` to first order from the last
+        linearization (x_k, u_k): u_k - (dR/du)^{-1} dR/df (x - x_k);
+        returns None if there is no linearization or no change of inputs
+        """
+        tangent = self.tangent
+        if tangent is None:
+            return None
+        dR_array = np.zeros(self.state['shape'])
+        for arg_name, dRdf_record in self.dRdf_dict.items():
+            dx = inputs[arg_name] - tangent['inputs'][arg_name]
+            if not np.any(dx):
+                continue
+            if dRdf_record['constant']:
+                dR_array += dRdf_record['dRdf']*dx
+            elif self.matrix_free:
+                update(self.state['jacvec_forms']['d_arguments'][arg_name],
+                        dx)
+                dR_array += assembleVector(
+                                self.state['jacvec_compiled']['fwd', arg_name])
+            else:
+                update(dRdf_record['df'], dx)
+                dR_array += computeMatVecProductFwd(dRdf_record['dRdf'],
+                                                dRdf_record['df'],
+                                                self.dR_vec)
+        if not np.any(dR_array):
+            return None
+        # The Dirichlet dofs are not moved by the predictor
+        dR_array[getBCDofs(self.bcs)] = 0.
+        du = self.fea.solveLinearFwd(self.du, self.A, self.dR, dR_array,
+                                    solver=self.linear_solver)
+        return tangent['state'] - du
+
+    def applyPredictor(self, inputs):
+        """
+        Replace the initial guess of the state solve by the predicted
+        state, unless the prediction raises the residual
+        """
+        predicted_state = self.predictState(inputs)
+        if predicted_state is None:
+            return
+        function = self.state['function']
+        residual = self.state['residual_compiled']
+        previous_state = np.array(getFuncArray(function))
+        previous_norm = computeResidualNorm(residual, self.bcs)
+        update(function, predicted_state)
+        predicted_norm = computeResidualNorm(residual, self.bcs)
+        if predicted_norm >= previous_norm:
+            update(function, previous_state)
+        if self.fea.REPORT:
+            print(" FEA: residual norm of the initial guess of "
+                    +self.state_name+": "+str(previous_norm)
+                    +" (previous state), "+str(predicted_norm)
+                    +" (tangent predictor)")
+
+    def getDesignVector(self, inputs):
+        return np.concatenate([np.ravel(inputs[arg_name])
+                                for arg_name in sorted(self.args_dict)])
+
     def compute_derivatives(self, inputs, outputs, derivatives):
         if self.debug_mode == True:
             print(str(self.state_name)+"="*40)
             print("CSDL: Running compute_derivatives()...")
             print("="*40)
 
+        self.linearize(inputs, outputs)
+        if self.matrix_free:
+            return
+
+        derivatives[self.state_name, self.state_name] = getCSRValues(
+                                                            self.dRdu)
+        for arg_name, dR_df in zip(self.state['arguments'],
+                                    self.state['dR_df_compiled_list']):
+            if self.dRdf_dict[arg_name]['constant']:
+                derivatives[self.state_name, arg_name] = np.reshape(
+                                    self.dRdf_dict[arg_name]['dRdf'], (-1,1))
+                continue
+            dRdf = assembleMatrix(dR_df, A=self.dRdf_dict[arg_name]['dRdf'])
+            derivatives[self.state_name, arg_name] = getCSRValues(dRdf)
+
+    def linearize(self, inputs, outputs):
+        """
+        Assemble dR/du and the dense dR/df columns of the scalar inputs at
+        (inputs, outputs), and set up the linear solver of the derivative
+        solves with dR/du
+        """
         for arg_name in inputs:
             update(self.args_dict[arg_name]['function'], inputs[arg_name])
         update(self.state['function'], outputs[self.state_name])
 
         state = self.state
-        args_dict = self.args_dict
-        dR_du = state['dR_du']
-        if dR_du == None:
-            dR_du = computePartials(state['residual_form'],state['function'])
-        self.dRdu = assembleMatrix(dR_du)
-
-        dRdf_dict = dict()
-        dR_df_list = state['dR_df_list']
-        arg_list = state['arguments']
-        for arg_ind in range(len(arg_list)):
-            arg_name = arg_list[arg_ind]
-            if dR_df_list == []:
-                dR_df = computePartials(state['residual_form'],
-                                    args_dict[arg_name]['function'])
-                dRdf = assembleMatrix(dR_df)
-            else:
-                dRdf = dR_df_list[arg_ind]
-
-            df = createFunction(args_dict[arg_name]['function'])
-            dRdf_dict[arg_name] = dict(dRdf=dRdf, df=df)
+        # Assemble dR/du once without BCs for the jacvec products, and
+        # apply the BCs on a copy of it for `apply_inverse_jacobian`
+        assembleMatrix(state['dR_du_compiled'], A=self.dRdu)
+        self.dRdu.copy(self.A,
+                    structure=PETSc.Mat.Structure.SAME_NONZERO_PATTERN)
+        applyBCToMatrix(self.A, self.bcs)
+        for arg_name, dR_df in zip(state['arguments'],
+                                    state['dR_df_compiled_list']):
+            if self.dRdf_dict[arg_name]['constant']:
+                self.dRdf_dict[arg_name]['dRdf'] = assembleVector(dR_df)
+        if self.fea.REPORT and self.linear_solver.warm_start:
+            info = self.linear_solver.info()
+            print(" FEA: derivative solves of "+self.state_name+": "
+                    +str(info['iterations'])+" Krylov iterations, "
+                    +str(info['iterations_saved'])+" saved by warm starts")
+        if self.fea.REPORT and self.linear_solver.max_pc_lag > 0:
+            info = self.linear_solver.info()
+            print(" FEA: derivative solves of "+self.state_name+": "
+                    +str(info['pc_setups'])+" preconditioner setups in "
+                    +str(info['linearizations'])+" linearizations")
+        # For a linear state, the KSP of the state solve factorized
+        # exactly this operator
+        self.linear_solver.setOperator(self.A,
+                        ksp=self.getNewtonKSP(inputs, outputs),
+                        exact=self.state['linear'])
+        # Keep the linearization point for the tangent predictor
+        self.tangent = dict(
+            inputs={arg_name: np.array(inputs[arg_name])
+                        for arg_name in inputs},
+            state=np.array(outputs[self.state_name]))
 
-        self.dRdf_dict = dRdf_dict
-        self.A,_ = assembleSystem(dR_du,
-                                state['residual_form'],
-                                bcs=self.bcs)
-
-        self.dR = self.state['d_residual']
-        self.du = self.state['d_state']
+    def isLinearizedAt(self, inputs, outputs):
+        """
+        Check if the last linearization is at (inputs, outputs)
+        """
+        tangent = self.tangent
+        if tangent is None:
+            return False
+        if not np.array_equal(outputs[self.state_name], tangent['state']):
+            return False
+        for arg_name in inputs:
+            if not np.array_equal(inputs[arg_name],
+                                    tangent['inputs'][arg_name]):
+                return False
+        return True
 
+    def getNewtonKSP(self, inputs, outputs):
+        """
+        Get the KSP of the last Newton iteration if the inputs and the
+        state have not changed since the nonlinear solve
+        """
+        linearization = self.newton_linearization
+        if linearization is None:
+            return None
+        if not np.array_equal(outputs[self.state_name],
+                                linearization['state']):
+            return None
+        for arg_name in inputs:
+            if not np.array_equal(inputs[arg_name],
+                                    linearization['inputs'][arg_name]):
+                return None
+        return linearization['ksp']
 
     def compute_jacvec_product(self, inputs, outputs,
                                 d_inputs, d_outputs, d_residuals, mode):
@@ -157,31 +356,90 @@ class StateOperation(CustomImplicitOperation):
         ######################
         state_name = self.state_name
         args_dict = self.args_dict
+        if self.matrix_free:
+            # Without declared partials, the linearization may not have
+            # been assembled at this point yet
+            if not self.isLinearizedAt(inputs, outputs):
+                self.linearize(inputs, outputs)
+            self.computeJacVecProductMatrixFree(d_inputs, d_outputs,
+                                                d_residuals, mode)
+            return
         if mode == 'fwd':
             if state_name in d_residuals:
                 if state_name in d_outputs:
                     update(self.du, d_outputs[state_name])
                     d_residuals[state_name] += computeMatVecProductFwd(
-                            self.dRdu, self.du)
+                            self.dRdu, self.du, self.dR_vec)
                 for arg_name in self.dRdf_dict:
                     if arg_name in d_inputs:
+                        dRdf = self.dRdf_dict[arg_name]['dRdf']
+                        if self.dRdf_dict[arg_name]['constant']:
+                            d_residuals[state_name] += dRdf*d_inputs[arg_name]
+                            continue
                         update(self.dRdf_dict[arg_name]['df'],
                                 d_inputs[arg_name])
-                        dRdf = self.dRdf_dict[arg_name]['dRdf']
                         d_residuals[state_name] += computeMatVecProductFwd(
-                                dRdf, self.dRdf_dict[arg_name]['df'])
+                                dRdf, self.dRdf_dict[arg_name]['df'],
+                                self.dR_vec)
 
         if mode == 'rev':
             if state_name in d_residuals:
                 update(self.dR, d_residuals[state_name])
                 if state_name in d_outputs:
                     d_outputs[state_name] += computeMatVecProductBwd(
-                            self.dRdu, self.dR)
+                            self.dRdu, self.dR, self.du_vec)
                 for arg_name in self.dRdf_dict:
                     if arg_name in d_inputs:
                         dRdf = self.dRdf_dict[arg_name]['dRdf']
+                        if self.dRdf_dict[arg_name]['constant']:
+                            d_inputs[arg_name] += np.dot(dRdf,
+                                                    d_residuals[state_name])
+                            continue
                         d_inputs[arg_name] += computeMatVecProductBwd(
-                                dRdf, self.dR)
+                                dRdf, self.dR,
+                                self.dRdf_dict[arg_name]['df_vec'])
+
+    def computeJacVecProductMatrixFree(self, d_inputs, d_outputs,
+                                        d_residuals, mode):
+        """
+        Compute the Jacobian-vector products with the assembled dR/du for
+        the state, and from the action forms of dR/df for the inputs
+        """
+        state_name = self.state_name
+        jacvec = self.state['jacvec_compiled']
+        d_arguments = self.state['jacvec_forms']['d_arguments']
+        if state_name not in d_residuals:
+            return
+        if mode == 'fwd':
+            if state_name in d_outputs:
+                update(self.du, d_outputs[state_name])
+                d_residuals[state_name] += computeMatVecProductFwd(
+                                                self.dRdu, self.du, self.dR_vec)
+            for arg_name in self.dRdf_dict:
+                if arg_name not in d_inputs:
+                    continue
+                if self.dRdf_dict[arg_name]['constant']:
+                    d_residuals[state_name] += (
+                        self.dRdf_dict[arg_name]['dRdf']*d_inputs[arg_name])
+                    continue
+                update(d_arguments[arg_name], d_inputs[arg_name])
+                d_residuals[state_name] += assembleVector(
+                                                jacvec['fwd', arg_name])
+
+        if mode == 'rev':
+            update(self.dR, d_residuals[state_name])
+            if state_name in d_outputs:
+                d_outputs[state_name] += computeMatVecProductBwd(
+                                                self.dRdu, self.dR, self.du_vec)
+            for arg_name in self.dRdf_dict:
+                if arg_name not in d_inputs:
+                    continue
+                if self.dRdf_dict[arg_name]['constant']:
+                    d_inputs[arg_name] += np.dot(
+                                        self.dRdf_dict[arg_name]['dRdf'],
+                                        d_residuals[state_name])
+                    continue
+                d_inputs[arg_name] += assembleVector(jacvec['rev', arg_name])
 
     def apply_inverse_jacobian(self, d_outputs, d_residuals, mode):
         if self.debug_mode == True:
@@ -192,7 +450,12 @@ class StateOperation(CustomImplicitOperation):
         state_name = self.state_name
         if mode == 'fwd':
             d_outputs[state_name] = self.fea.solveLinearFwd(
-                            self.du, self.A, self.dR, d_residuals[state_name])
+                            self.du, self.A, self.dR, d_residuals[state_name],
+                            solver=self.linear_solver)
         else:
-            d_residuals[state_name] = self.fea.solveLinearBwd(
-                            self.dR, self.A, self.du, d_outputs[state_name])
+            # The adjoint seeds, one or several stacked as rows, are solved
+            # as one block with the factorization of this linearization
+            seeds = d_outputs[state_name]
+            d_residuals[state_name] = np.reshape(
+                    self.linear_solver.solveBlock(seeds, transpose=True),
+                    np.shape(seeds))
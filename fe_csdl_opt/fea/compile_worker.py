@@ -0,0 +1,29 @@
+"""
+Worker process of `precompileForms`: compiles one pickled UFL form into
+the FFCx JIT cache. It only imports UFL and FFCx, so it neither re-runs
+the user's script nor initializes MPI/PETSc.
+
+Usage: python -m fe_csdl_opt.fea.compile_worker < job
+where the job is the pickled (pickled form, FFCx parameters,
+JIT parameters); the compile time is written to stdout.
+"""
+
+import sys
+import pickle
+from timeit import default_timer
+
+import ffcx.codegeneration.jit
+
+
+def main():
+    start = default_timer()
+    form_data, ffcx_params, jit_params = pickle.loads(sys.stdin.buffer.read())
+    ufl_form = pickle.loads(form_data)
+    ffcx.codegeneration.jit.compile_forms([ufl_form],
+                                            parameters=ffcx_params,
+                                            **jit_params)
+    sys.stdout.write(str(default_timer() - start))
+
+
+if __name__ == '__main__':
+    main()
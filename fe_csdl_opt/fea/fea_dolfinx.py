@@ -81,6 +81,7 @@ class FEA(object):
         self.inputs_dict = dict()
         self.states_dict = dict()
         self.outputs_dict = dict()
+        self.parameters_dict = dict()
         self.bc = []
 
         self.PDE_SOLVER = "Newton"
@@ -94,6 +95,23 @@ class FEA(object):
         self.initial_solve = True
 
         self.recorder_path = "records"
+        self.compile_times = dict()
+        # The long-lived nonlinear solvers, one per state function
+        self.nonlinear_solvers = dict()
+        # Memory budget (in bytes) of the history of the solved designs
+        # and states used to warm-start the state solves; 0 to turn it off
+        self.STATE_HISTORY_MEMORY = 0
+        # Start the state solves from the first-order prediction of the
+        # state at the new inputs, from the last derivative evaluation
+        self.TANGENT_PREDICTOR = False
+        # Solve the states with residuals affine in the state by a single
+        # linear solve in place of the Newton iterations
+        self.DETECT_LINEAR_STATES = False
+
+        # Quadrature policy for the registered forms: an explicit degree,
+        # or a cap on the estimated degrees; can be overridden per form
+        self.QUADRATURE_DEGREE = None
+        self.MAX_QUADRATURE_DEGREE = None
 
     def add_input(self, name, function):
         if name in self.inputs_dict:
@@ -105,23 +123,121 @@ class FEA(object):
             recorder=self.createRecorder(name, self.record)
         )
 
+    def add_parameter(self, name, value, input=False):
+        """
+        Add a runtime parameter as a DOLFINx Constant, to be used in the
+        forms in place of a Python float, so that changing its value does
+        not change the forms and trigger a new JIT compilation. With
+        `input=True`, the (scalar) parameter is also added as an input
+        with derivatives.
+        """
+        if name in self.parameters_dict or name in self.inputs_dict:
+            raise ValueError('name has already been used for a parameter')
+        constant = Constant(self.mesh,
+                            np.asarray(value, dtype=PETSc.ScalarType))
+        self.parameters_dict[name] = dict(
+            constant=constant,
+        )
+        if input:
+            if constant.value.size != 1:
+                raise ValueError('only scalar parameters can be inputs')
+            self.inputs_dict[name] = dict(
+                function=constant,
+                function_space=None,
+                shape=1,
+                recorder=None
+            )
+        return constant
+
+    def set_parameter(self, name, value):
+        """
+        Set the value of the runtime parameter
+        """
+        self.parameters_dict[name]['constant'].value = value
+
     def add_state(self, name, function, residual_form, arguments,
-                    dR_du=None, dR_df_list=[]):
+                    dR_du=None, dR_df_list=[],
+                    quadrature_degree=None, max_quadrature_degree=None,
+                    solver=None, matrix_free=False, linear=None):
+        """
+        `solver` is the spec of the linear solvers of the state (see the
+        README); `matrix_free` assembles the jacvec products w.r.t. the
+        inputs from action forms, and `linear` takes one linear solve
+        """
+        residual_form = self.applyQuadraturePolicy(residual_form,
+                                quadrature_degree, max_quadrature_degree)
+        # Build the symbolic partial derivatives once at registration
+        if dR_du is None:
+            dR_du = computePartials(residual_form, function)
+        if len(dR_df_list) == 0:
+            dR_df_list = []
+            for argument in arguments:
+                if argument not in self.inputs_dict:
+                    raise ValueError('argument '+argument+
+                                    ' has not been added as an input')
+                dR_df_list.append(computePartials(residual_form,
+                                    self.inputs_dict[argument]['function']))
+
+        if linear is None:
+            linear = (self.DETECT_LINEAR_STATES
+                        and isAffine(residual_form, function))
+
+        d_residual = Function(function.function_space)
+        d_state = Function(function.function_space)
+        jacvec_forms = None
+        if matrix_free:
+            jacvec_forms = self.createJacVecForms(d_residual, arguments,
+                                                dR_df_list)
 
         self.states_dict[name] = dict(
             function=function,
             residual_form=residual_form,
             function_space=function.function_space,
             shape=len(getFuncArray(function)),
-            d_residual=Function(function.function_space),
-            d_state=Function(function.function_space),
+            d_residual=d_residual,
+            d_state=d_state,
             dR_du=dR_du,
             dR_df_list=dR_df_list,
             arguments=arguments,
+            matrix_free=matrix_free,
+            linear=linear,
+            jacvec_forms=jacvec_forms,
+            # compiled forms, filled by `precompile`
+            residual_compiled=None,
+            dR_du_compiled=None,
+            dR_df_compiled_list=None,
+            jacvec_compiled=None,
+            solver=solver,
+            options_prefix=((solver or dict()).get('prefix')
+                                or uniqueOptionsPrefix(name)),
             recorder=self.createRecorder(name, self.record)
         )
 
-    def add_output(self, name, type, form, arguments):
+    def createJacVecForms(self, d_residual, arguments, dR_df_list):
+        """
+        Create the vector forms of the forward and reverse Jacobian-vector
+        products w.r.t. the inputs, keyed by (mode, input):
+        ('fwd', f): dR/df * d_f, ('rev', f): dR/df^T * d_residual,
+        and the functions `d_f` of the input perturbations; the products
+        w.r.t. the state use the assembled dR/du, and those w.r.t. the
+        Constant parameters the dR/df vectors.
+        """
+        forms = dict()
+        d_arguments = dict()
+        for argument, dR_df in zip(arguments, dR_df_list):
+            f = self.inputs_dict[argument]['function']
+            if isinstance(f, Constant):
+                continue
+            d_arguments[argument] = createFunction(f)
+            forms['fwd', argument] = ufl.action(dR_df, d_arguments[argument])
+            forms['rev', argument] = ufl.action(ufl.adjoint(dR_df),
+                                                d_residual)
+        return dict(forms=forms, d_arguments=d_arguments)
+
+    def add_output(self, name, type, form, arguments,
+                    quadrature_degree=None, max_quadrature_degree=None):
+        form = self.applyQuadraturePolicy(form,
+                                quadrature_degree, max_quadrature_degree)
         if type == 'field':
             shape = len(getFormArray(form))
         elif type == 'scalar':
@@ -129,17 +245,135 @@ class FEA(object):
         partials = []
         for argument in arguments:
             if argument in self.inputs_dict:
-                partial = derivative(form, self.inputs_dict[argument]['function'])
+                partial = computePartials(form,
+                                    self.inputs_dict[argument]['function'])
             elif argument in self.states_dict:
-                partial = derivative(form, self.states_dict[argument]['function'])
+                partial = computePartials(form,
+                                    self.states_dict[argument]['function'])
+            else:
+                raise ValueError('argument '+argument+
+                                ' has not been added as an input or a state')
             partials.append(partial)
         self.outputs_dict[name] = dict(
             form=form,
             shape=shape,
             arguments=arguments,
             partials=partials,
+            # compiled forms, filled by `precompile`
+            form_compiled=None,
+            partials_compiled=None,
         )
 
+    def applyQuadraturePolicy(self, form, degree=None, max_degree=None):
+        """
+        Set the quadrature degrees of the form by the given degree (or cap)
+        or by the FEA-level policy
+        """
+        if degree is None and max_degree is None:
+            degree = self.QUADRATURE_DEGREE
+            max_degree = self.MAX_QUADRATURE_DEGREE
+        return setQuadratureDegree(form, degree=degree, max_degree=max_degree)
+
+    def report_quadrature_degrees(self):
+        """
+        Report the estimated and the used quadrature degrees of the residual
+        and output forms
+        """
+        degrees = dict()
+        forms = [(name, state['residual_form'])
+                    for name, state in self.states_dict.items()]
+        forms += [(name, output['form'])
+                    for name, output in self.outputs_dict.items()]
+        for name, form in forms:
+            estimated = max(estimateQuadratureDegrees(
+                                removeQuadratureDegree(form)).values())
+            used = sorted(set(getQuadratureDegrees(form)), key=str)
+            degrees[name] = dict(estimated=estimated, used=used)
+            print(" FEA: quadrature degrees of", name,
+                    "- estimated:", estimated, "used:", used)
+        return degrees
+
+    def check_quadrature(self, name, degree=None, max_degree=None):
+        """
+        Compute the relative error of the residual (or output) form `name`
+        assembled with a lower quadrature degree against the reference
+        assembly with the estimated degrees
+        """
+        if name in self.states_dict:
+            form = self.states_dict[name]['residual_form']
+        else:
+            form = self.outputs_dict[name]['form']
+        error = checkQuadratureAccuracy(removeQuadratureDegree(form),
+                                        degree=degree, max_degree=max_degree)
+        if self.REPORT is True:
+            print(" FEA: relative error of", name, "with quadrature degree",
+                    degree if degree is not None else '<= '+str(max_degree),
+                    ":", error)
+        return error
+
+    def precompile(self, max_workers=None):
+        """
+        Compile all of the residual, output and partial derivative forms
+        that have not been compiled yet. The forms are compiled
+        concurrently in separate worker processes into the on-disk JIT
+        cache, and the compile time of each form is kept in
+        `self.compile_times`.
+        """
+        state_names = [name for name, state in self.states_dict.items()
+                            if state['residual_compiled'] is None]
+        output_names = [name for name, output in self.outputs_dict.items()
+                            if output['form_compiled'] is None]
+        labels = []
+        ufl_forms = []
+        for name in state_names:
+            state = self.states_dict[name]
+            labels += ['residual of '+name, 'dR/d'+name]
+            labels += ['dR/d'+arg for arg in state['arguments']]
+            ufl_forms += [state['residual_form'], state['dR_du']]
+            ufl_forms += list(state['dR_df_list'])
+            if state['matrix_free']:
+                for mode, variable in state['jacvec_forms']['forms']:
+                    labels += [mode+' product of dR/d'+variable]
+                ufl_forms += list(state['jacvec_forms']['forms'].values())
+        for name in output_names:
+            output = self.outputs_dict[name]
+            labels += [name]
+            labels += ['d'+name+'/d'+arg for arg in output['arguments']]
+            ufl_forms += [output['form']] + list(output['partials'])
+        if len(ufl_forms) == 0:
+            return
+
+        times = precompileForms(ufl_forms, max_workers=max_workers,
+                                labels=labels)
+        compiled_forms = []
+        for i, ufl_form in enumerate(ufl_forms):
+            start = default_timer()
+            compiled_forms.append(compileForm(ufl_form))
+            times[i] += default_timer() - start
+
+        compiled_forms = iter(compiled_forms)
+        for name in state_names:
+            state = self.states_dict[name]
+            state['residual_compiled'] = next(compiled_forms)
+            state['dR_du_compiled'] = next(compiled_forms)
+            state['dR_df_compiled_list'] = [next(compiled_forms)
+                                            for dR_df in state['dR_df_list']]
+            if state['matrix_free']:
+                state['jacvec_compiled'] = {key: next(compiled_forms)
+                            for key in state['jacvec_forms']['forms']}
+        for name in output_names:
+            output = self.outputs_dict[name]
+            output['form_compiled'] = next(compiled_forms)
+            output['partials_compiled'] = [next(compiled_forms)
+                                            for partial in output['partials']]
+
+        self.compile_times.update(zip(labels, times))
+        if self.REPORT is True:
+            print("="*40)
+            for label, time in zip(labels, times):
+                print(" FEA: compiled", label, "in", time, "seconds")
+            print("="*40)
+
     def add_exact_solution(self, Expression, function_space):
         f_analytic = Expression()
         f_ex = Function(function_space)
@@ -155,40 +389,89 @@ class FEA(object):
             for locate_BC in locate_BC_list:
                 self.bc.append(dirichletbc(ubc, locate_BC, function_space))
 
-    def solve(self, res, func, bc):
+    def solve(self, res, func, bc, options=None, prefix=None, linear=False):
         """
-        Solve the PDE problem
+        Solve the PDE problem; `options` is the linear solver spec
+        and `prefix` the PETSc options prefix of the state, and a `linear`
+        problem takes a single linear solve. Returns the KSP of the last
+        Newton iteration, or None for the custom solves.
         """
         solver_type=self.PDE_SOLVER
+        if linear:
+            solver_type='Linear'
         report=self.REPORT
         if self.custom_solve is not None and self.initial_solve == True:
             self.custom_solve(res,func,bc,report)
             # self.initial_solve = False
+            return None
         else:
-            solveNonlinear(res,func,bc,solver_type,report)
+            nonlinear_solver = self.getNonlinearSolver(res,func,bc,
+                                        options=options, prefix=prefix,
+                                        linear=linear)
+            return solveNonlinear(res,func,bc,solver_type,report,
+                                    nonlinear_solver=nonlinear_solver)
+
+    def getNonlinearSolver(self, res, func, bc, options=None, prefix=None,
+                            linear=False):
+        """
+        Get the nonlinear solver (of type `PDE_SOLVER`, or a
+        `LinearStateSolver` for a `linear` problem) of the problem
+        res(func)=0; it is created with its Jacobian matrix, residual
+        vector and KSP at the first call, and reused by the later solves
+        of the same residual form, including the custom solves
+        """
+        solver_type = 'Linear' if linear else self.PDE_SOLVER
+        key = id(func)
+        if key in self.nonlinear_solvers:
+            record = self.nonlinear_solvers[key]
+            if (record['residual_form'] is res
+                    and record['solver_type'] == solver_type
+                    and len(record['bc']) == len(bc)
+                    and all(a is b for a, b in zip(record['bc'], bc))):
+                return record['solver']
+        if prefix is not None:
+            prefix += solver_type.lower()+'_'
+        solver = createNonlinearSolver(res, func, bc, solver_type,
+                                        self.REPORT, options=options,
+                                        prefix=prefix)
+        self.nonlinear_solvers[key] = dict(
+            residual_form=res,
+            solver_type=solver_type,
+            bc=list(bc),
+            solver=solver,
+        )
+        return solver
 
 
-    def solveLinearFwd(self, du, A, dR, dR_array):
+    def solveLinearFwd(self, du, A, dR, dR_array, solver=None):
         """
-        solve linear system dR = dR_du (A) * du in DOLFIN type
+        solve linear system dR = dR_du (A) * du in DOLFIN type;
+        `solver` is the `LinearSolver` holding the factorization of `A`
         """
         setFuncArray(dR, dR_array)
 
         du.vector.set(0.0)
 
-        solveKSP(A, dR.vector, du.vector)
+        if solver is None:
+            solveKSP(A, dR.vector, du.vector)
+        else:
+            solver.solve(dR.vector, du.vector)
         du.vector.assemble()
         du.vector.ghostUpdate()
         return du.vector.getArray()
 
-    def solveLinearBwd(self, dR, A, du, du_array):
+    def solveLinearBwd(self, dR, A, du, du_array, solver=None):
         """
-        solve linear system du = dR_du.T (A_T) * dR in DOLFIN type
+        solve linear system du = dR_du.T (A_T) * dR in DOLFIN type;
+        `solver` is the `LinearSolver` holding the factorization of `A`
         """
         setFuncArray(du, du_array)
 
         dR.vector.set(0.0)
-        solveKSP(transpose(A), du.vector, dR.vector)
+        if solver is None:
+            solveKSP(A, du.vector, dR.vector, transpose=True)
+        else:
+            solver.solveTranspose(du.vector, dR.vector)
         dR.vector.assemble()
         dR.vector.ghostUpdate()
         return dR.vector.getArray()
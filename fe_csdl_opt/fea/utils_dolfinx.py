@@ -12,7 +12,7 @@ from dolfinx.mesh import (create_unit_square, create_rectangle, create_interval,
                             meshtags)
 from dolfinx.cpp.mesh import CellType
 from dolfinx.fem import (form, assemble_scalar, Function, FunctionSpace,
-                        dirichletbc, locate_dofs_geometrical)
+                        Constant, dirichletbc, locate_dofs_geometrical)
 from dolfinx.fem.petsc import (assemble_vector, assemble_matrix,
                         NonlinearProblem, apply_lifting, set_bc,
                         create_matrix, _assemble_matrix_mat,)
@@ -24,6 +24,21 @@ from mpi4py import MPI
 import numpy as np
 from scipy.spatial import KDTree
 from configparser import ConfigParser
+from collections import OrderedDict
+from contextlib import ExitStack
+import itertools
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from timeit import default_timer
+import multiprocessing
+import subprocess
+import sys
+import warnings
+import os
+import ffcx
+import pickle
+import io
+import ufl
+import ufl.algorithms
 
 DOLFIN_EPS = 3E-16
 comm = MPI.COMM_WORLD
@@ -162,41 +177,309 @@ def setFuncArray(v, v_array):
     v.vector.assemble()
     v.vector.ghostUpdate()
 
+class FormCache(object):
+    """
+    LRU cache of the compiled DOLFINx forms, keyed by the UFL signature
+    of the form and the identity of its coefficients, constants and
+    subdomain data, so that the same UFL expression is only sent through
+    the FFCx JIT lookup and the form construction once.
+    """
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.forms = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def key(self, ufl_form):
+        subdomain_data = []
+        for domain_data in ufl_form.subdomain_data().values():
+            for integral_type in sorted(domain_data):
+                subdomain_data.append((integral_type,
+                                        id(domain_data[integral_type])))
+        return (ufl_form.signature(),
+                tuple(id(c) for c in ufl_form.coefficients()),
+                tuple(id(c) for c in ufl_form.constants()),
+                tuple(id(d) for d in ufl_form.ufl_domains()),
+                tuple(subdomain_data))
+
+    def __call__(self, ufl_form):
+        """
+        Return the compiled form of `ufl_form`; the objects that are not
+        UFL forms (e.g. the already compiled forms) are passed through.
+        """
+        if not isinstance(ufl_form, ufl.Form):
+            return ufl_form
+        key = self.key(ufl_form)
+        if key in self.forms:
+            self.hits += 1
+            self.forms.move_to_end(key)
+            return self.forms[key][1]
+        self.misses += 1
+        compiled_form = form(ufl_form)
+        # Keep a reference to the UFL form so that the ids in the key
+        # can not be reused by other objects while the entry is alive
+        self.forms[key] = (ufl_form, compiled_form)
+        if self.maxsize is not None and len(self.forms) > self.maxsize:
+            self.forms.popitem(last=False)
+            self.evictions += 1
+        return compiled_form
+
+    def info(self):
+        return dict(hits=self.hits,
+                    misses=self.misses,
+                    evictions=self.evictions,
+                    maxsize=self.maxsize,
+                    currsize=len(self.forms))
+
+    def clear(self):
+        self.forms.clear()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+form_cache = FormCache()
+
+def compileForm(f):
+    """
+    Compile the UFL form `f` through the global form cache
+    """
+    return form_cache(f)
+
+class StateHistory(object):
+    """
+    Bounded history of the (design vector, converged state) pairs of a
+    state, for warm-starting the nonlinear solves from the state of the
+    closest previously solved design; the least recently used pairs are
+    evicted once the arrays take more than `max_bytes`.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.count = 0
+        self.nbytes = 0
+        self.hits = 0
+        self.evictions = 0
+
+    def add(self, design, state):
+        design = np.array(design)
+        state = np.array(state)
+        self.entries[self.count] = (design, state)
+        self.count += 1
+        self.nbytes += design.nbytes + state.nbytes
+        while self.nbytes > self.max_bytes and len(self.entries) > 0:
+            _, (d, u) = self.entries.popitem(last=False)
+            self.nbytes -= d.nbytes + u.nbytes
+            self.evictions += 1
+
+    def nearest(self, design):
+        """
+        Return the state of the closest design in the history,
+        or None for an empty history
+        """
+        if len(self.entries) == 0:
+            return None
+        keys = list(self.entries.keys())
+        distances = [np.linalg.norm(self.entries[key][0] - design)
+                        for key in keys]
+        key = keys[int(np.argmin(distances))]
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return self.entries[key][1]
+
+    def info(self):
+        return dict(hits=self.hits,
+                    evictions=self.evictions,
+                    nbytes=self.nbytes,
+                    max_bytes=self.max_bytes,
+                    currsize=len(self.entries))
+
+class UFLPickler(pickle.Pickler):
+    """
+    Pickler for the UFL forms that replaces the DOLFINx objects attached to
+    the forms (mesh, function spaces, functions, constants and subdomain
+    data) by their pure UFL counterparts, which is all that the form
+    compiler needs, so that the forms can be compiled in other processes
+    """
+    def reducer_override(self, obj):
+        if isinstance(obj, ufl.Mesh) and obj.ufl_cargo() is not None:
+            return ufl.Mesh, (obj.ufl_coordinate_element(), obj.ufl_id())
+        elif (isinstance(obj, ufl.FunctionSpace)
+                and type(obj) is not ufl.FunctionSpace):
+            return ufl.FunctionSpace, (obj.ufl_domain(), obj.ufl_element())
+        elif (isinstance(obj, ufl.Coefficient)
+                and type(obj) is not ufl.Coefficient):
+            return ufl.Coefficient, (obj.ufl_function_space(), obj.count())
+        elif (isinstance(obj, ufl.Constant)
+                and type(obj) is not ufl.Constant):
+            return ufl.Constant, (obj.ufl_domain(), obj.ufl_shape,
+                                    obj.count())
+        elif type(obj).__module__.startswith('dolfinx'):
+            return type(None), ()
+        return NotImplemented
+
+def pickleForm(ufl_form):
+    """
+    Serialize the UFL form with `UFLPickler`
+    """
+    f = io.BytesIO()
+    UFLPickler(f, protocol=pickle.HIGHEST_PROTOCOL).dump(ufl_form)
+    return f.getvalue()
+
+def _scalarTypeName():
+    return {np.dtype(np.float32): "float",
+            np.dtype(np.float64): "double",
+            np.dtype(np.complex128): "double _Complex"}[
+                                        np.dtype(PETSc.ScalarType)]
+
+def _compileFormJob(ufl_form):
+    """
+    Pickle the UFL form with the same FFCx and JIT parameters as
+    `dolfinx.fem.form`, for `fe_csdl_opt.fea.compile_worker`
+    """
+    ffcx_params = ffcx.get_parameters({"scalar_type": _scalarTypeName()})
+    jit_params = dolfinx.jit.get_parameters()
+    return pickle.dumps((pickleForm(ufl_form), ffcx_params, jit_params),
+                        protocol=pickle.HIGHEST_PROTOCOL)
+
+def _runCompileWorker(job):
+    """
+    Compile the pickled job in a fresh `compile_worker` process and
+    return the compile time
+    """
+    env = {key: value for key, value in os.environ.items()
+            if not key.startswith(('OMPI_', 'PMI_', 'PMIX_', 'MPI_'))}
+    result = subprocess.run(
+                [sys.executable, '-m', 'fe_csdl_opt.fea.compile_worker'],
+                input=job, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                env=env)
+    if result.returncode != 0:
+        raise RuntimeError('the compile worker exited with code '
+                            +str(result.returncode)+':\n'
+                            +result.stderr.decode(errors='replace').strip())
+    return float(result.stdout)
+
+def precompileForms(ufl_forms, max_workers=None, labels=None):
+    """
+    Compile the UFL forms concurrently into the on-disk JIT cache of
+    DOLFINx on the first rank, so that the following `compileForm` calls
+    on all ranks only load the compiled modules. Each form is compiled in
+    a separate `python -m fe_csdl_opt.fea.compile_worker` process, which
+    does not import the user's script or MPI. Returns the compile time of
+    each form; the forms that can not be compiled this way are left for
+    `compileForm` with a zero time, with a warning naming them by `labels`.
+    """
+    times = [0.]*len(ufl_forms)
+    if labels is None:
+        labels = ['form '+str(i) for i in range(len(ufl_forms))]
+    if len(ufl_forms) > 1 and max_workers != 1 and comm.rank == 0:
+        if max_workers is None:
+            max_workers = multiprocessing.cpu_count()
+        jobs = dict()
+        failures = []
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for i, ufl_form in enumerate(ufl_forms):
+                try:
+                    job = _compileFormJob(ufl_form)
+                except Exception as e:
+                    failures.append((i, 'can not be pickled: '+repr(e)))
+                    continue
+                jobs[executor.submit(_runCompileWorker, job)] = i
+            for job in as_completed(jobs):
+                try:
+                    times[jobs[job]] = job.result()
+                except Exception as e:
+                    failures.append((jobs[job], str(e)))
+        if len(failures) > 0:
+            warnings.warn("the forms below are compiled in-process by "
+                    "the JIT instead:\n"+"\n".join(
+                        " - "+labels[i]+": "+reason
+                        for i, reason in sorted(failures)))
+    times = comm.bcast(times, root=0)
+    return times
+
 def assembleScalar(c):
     """
     Compute the array representation of the scalar form
     """
-    return assemble_scalar(form(c))
+    return assemble_scalar(compileForm(c))
 
 def assembleVector(v):
     """
     Compute the array representation of the vector form
     """
-    return assemble_vector(form(v)).array
+    return assemble_vector(compileForm(v)).array
 
-def assembleMatrix(M, bcs=[]):
+def getFormArray(F):
     """
-    Compute the array representation of the matrix form
+    Compute the array representation of the vector form for
+    the field outputs
     """
-    M_ = assemble_matrix(form(M), bcs=bcs)
-    M_.assemble()
-    return M_
+    return assembleVector(F)
 
-def assembleSystem(J, F, bcs=[]):
+def createMatrix(M):
     """
-    Compute the array representations of the linear system
+    Create the PETSc matrix preallocated with the sparsity pattern
+    of the matrix form
     """
-    a = form(J)
-    L = form(F)
-    A = assemble_matrix(a, bcs=bcs)
+    return create_matrix(compileForm(M))
+
+def assembleMatrix(M, bcs=[], A=None):
+    """
+    Compute the array representation of the matrix form; if the
+    preallocated matrix `A` is given, it is zeroed and reassembled in place
+    """
+    a = compileForm(M)
+    if A is None:
+        A = assemble_matrix(a, bcs=bcs)
+    else:
+        A.zeroEntries()
+        assemble_matrix(A, a, bcs=bcs)
     A.assemble()
-    L = form(F)
+    return A
+
+def assembleSystem(J, F, bcs=[], A=None):
+    """
+    Compute the array representations of the linear system
+    """
+    A = assembleMatrix(J, bcs=bcs, A=A)
+    L = compileForm(F)
     b = assemble_vector(L)
-    apply_lifting(b, [a], [bcs])
+    apply_lifting(b, [compileForm(J)], [bcs])
     b.ghostUpdate(PETSc.InsertMode.ADD_VALUES, PETSc.ScatterMode.REVERSE)
     set_bc(b, bcs)
     return A, b
 
+def applyBCToMatrix(A, bcs, diagonal=1.0):
+    """
+    Zero the rows and columns of the assembled matrix `A` for the
+    Dirichlet dofs in `bcs` and set `diagonal` on their diagonal entries,
+    which gives the same operator as the assembly with the `bcs`
+    """
+    A.zeroRowsColumnsLocal(getBCDofs(bcs), diag=diagonal)
+    return A
+
+def getBCDofs(bcs):
+    """
+    Get the local indices of the owned Dirichlet dofs in `bcs`
+    """
+    rows = [np.zeros(0, dtype=np.int32)]
+    for bc in bcs:
+        dofs, first_ghost = bc.dof_indices()
+        rows.append(dofs[:first_ghost])
+    return np.unique(np.concatenate(rows)).astype(np.int32)
+
+def computeResidualNorm(F, bcs=[]):
+    """
+    Compute the l2 norm of the residual vector of the form `F`,
+    excluding the Dirichlet dofs in `bcs`
+    """
+    b = assemble_vector(compileForm(F))
+    b.ghostUpdate(addv=PETSc.InsertMode.ADD, mode=PETSc.ScatterMode.REVERSE)
+    with b.localForm() as b_local:
+        b_local.array[getBCDofs(bcs)] = 0.
+    return b.norm()
+
 def assemble(f, dim=0, bcs=[]):
     if dim == 0:
         return assembleScalar(f)
@@ -217,6 +500,110 @@ def assemble_partials(of=None, wrt=None):
     partials = derivative(of, wrt)
     return assemble(partials, dim=2)
 
+def estimateQuadratureDegrees(F):
+    """
+    Estimate the quadrature degrees of the integrals in the form, as done by
+    the form compiler when no degree is given; returns a dict keyed by
+    (integral type, subdomain id)
+    """
+    form_data = ufl.algorithms.compute_form_data(F,
+                        do_apply_function_pullbacks=True,
+                        do_apply_integral_scaling=True,
+                        do_apply_geometry_lowering=True,
+                        preserve_geometry_types=(ufl.classes.Jacobian,),
+                        do_apply_restrictions=True,
+                        do_append_everywhere_integrals=False)
+    degrees = dict()
+    for integral_data in form_data.integral_data:
+        key = (integral_data.integral_type, integral_data.subdomain_id)
+        for integral in integral_data.integrals:
+            degree = integral.metadata()["estimated_polynomial_degree"]
+            degrees[key] = max(degrees.get(key, 0), np.max(degree))
+    return degrees
+
+def _integralKey(integral):
+    subdomain_id = integral.subdomain_id()
+    if subdomain_id == "everywhere":
+        subdomain_id = "otherwise"
+    return (integral.integral_type(), subdomain_id)
+
+def setQuadratureDegree(F, degree=None, max_degree=None):
+    """
+    Set the quadrature degree of every integral in the form to `degree`,
+    or to its given/estimated degree capped at `max_degree`
+    """
+    if degree is None and max_degree is None:
+        return F
+    if degree is None:
+        estimated_degrees = estimateQuadratureDegrees(F)
+    integrals = []
+    for integral in F.integrals():
+        metadata = dict(integral.metadata())
+        if degree is not None:
+            metadata["quadrature_degree"] = degree
+        else:
+            integral_degree = metadata.get("quadrature_degree")
+            if integral_degree is None:
+                integral_degree = estimated_degrees.get(_integralKey(integral),
+                                            max(estimated_degrees.values()))
+            metadata["quadrature_degree"] = min(integral_degree, max_degree)
+        integrals.append(integral.reconstruct(metadata=metadata))
+    return ufl.Form(integrals)
+
+def getQuadratureDegrees(F):
+    """
+    Get the quadrature degrees set in the metadata of the integrals in the
+    form, with None for the integrals using the estimated degree
+    """
+    return [integral.metadata().get("quadrature_degree")
+                for integral in F.integrals()]
+
+def removeQuadratureDegree(F):
+    """
+    Remove the quadrature degrees from the metadata of the integrals in the
+    form, so that the form compiler uses the estimated degrees
+    """
+    integrals = []
+    for integral in F.integrals():
+        metadata = dict(integral.metadata())
+        metadata.pop("quadrature_degree", None)
+        integrals.append(integral.reconstruct(metadata=metadata))
+    return ufl.Form(integrals)
+
+def checkQuadratureAccuracy(F, degree=None, max_degree=None, F_ref=None):
+    """
+    Compute the relative error of the assembly of the form with the
+    quadrature degree `degree` (or capped at `max_degree`) against the
+    reference assembly of `F_ref` (by default, `F` with the estimated
+    degrees)
+    """
+    if F_ref is None:
+        F_ref = removeQuadratureDegree(F)
+    F_q = setQuadratureDegree(F_ref, degree=degree, max_degree=max_degree)
+    rank = len(F_ref.arguments())
+    if rank == 0:
+        value_ref = comm.allreduce(assembleScalar(F_ref), op=MPI.SUM)
+        error = abs(comm.allreduce(assembleScalar(F_q), op=MPI.SUM)
+                    - value_ref)
+        norm_ref = abs(value_ref)
+    elif rank == 1:
+        b_ref = assemble_vector(compileForm(F_ref))
+        b_ref.ghostUpdate(PETSc.InsertMode.ADD, PETSc.ScatterMode.REVERSE)
+        b = assemble_vector(compileForm(F_q))
+        b.ghostUpdate(PETSc.InsertMode.ADD, PETSc.ScatterMode.REVERSE)
+        norm_ref = b_ref.norm()
+        b.axpy(-1.0, b_ref)
+        error = b.norm()
+    else:
+        A_ref = assembleMatrix(F_ref)
+        A = assembleMatrix(F_q)
+        norm_ref = A_ref.norm()
+        A.axpy(-1.0, A_ref)
+        error = A.norm()
+    if norm_ref == 0.:
+        return error
+    return error/norm_ref
+
 def errorNorm(v, v_ex, norm='L2'):
     """
     Calculate the L2 norm of two functions
@@ -224,10 +611,10 @@ def errorNorm(v, v_ex, norm='L2'):
     comm = MPI.COMM_WORLD
     l2_error = (v - v_ex)**2 * dx
     if norm == 'L2':
-        error = form(l2_error)
+        error = compileForm(l2_error)
     elif norm == 'H1':
         h1_error = l2_error + (grad(v) - grad(v_ex))**2 * dx
-        error = form(h1_error)
+        error = compileForm(h1_error)
     E = np.sqrt(comm.allreduce(assemble_scalar(error), MPI.SUM))
     return E
 
@@ -248,35 +635,60 @@ def convertToCOO(A):
 
     return A_csr.tocoo()
 
-def computeMatVecProductFwd(A, x):
+def getCSRPattern(A):
+    """
+    Get the row and column indices of the nonzero entries of the assembled
+    PETSc matrix, in the order of the values from `A.getValuesCSR()`
+    """
+    indptr, indices, _ = A.getValuesCSR()
+    row_start, _ = A.getOwnershipRange()
+    rows = np.repeat(np.arange(row_start, row_start+len(indptr)-1,
+                                dtype=np.int32),
+                    np.diff(indptr))
+    return rows, indices
+
+def getCSRValues(A):
+    """
+    Get the values of the nonzero entries of the assembled PETSc matrix,
+    in the order of the indices from `getCSRPattern(A)`
+    """
+    return A.getValuesCSR()[2]
+
+def computeMatVecProductFwd(A, x, y=None):
     """
     Compute y = A * x
     A: PETSc matrix
     x: ufl function
+    y: (optional) preallocated PETSc vector for the result
     """
-    y = A*x.vector
+    if y is None:
+        y = A*x.vector
+    else:
+        A.mult(x.vector, y)
     y.assemble()
     return y.getArray()
 
 def applyBC(res, u, bcs):
-    a = form(derivative(res, u))
-    L = form(res)
+    a = compileForm(derivative(res, u))
+    L = compileForm(res)
     b = assemble_vector(L)
     apply_lifting(b, [a], [bcs])
     b.ghostUpdate(PETSc.InsertMode.ADD_VALUES, PETSc.ScatterMode.REVERSE)
     dolfinx.fem.petsc.set_bc(b, bcs)
     return b.array
 
-def computeMatVecProductBwd(A, R):
+def computeMatVecProductBwd(A, R, y=None):
     """
     Compute y = A.T * R
     A: PETSc matrix
     R: ufl function
+    y: (optional) preallocated PETSc vector for the result
     """
-    row, col = A.getSizes()
-    y = PETSc.Vec().create()
-    y.setSizes(col)
-    y.setUp()
+    if y is None:
+        row, col = A.getSizes()
+        y = PETSc.Vec().create()
+        y.setSizes(col)
+        y.setUp()
     A.multTranspose(R.vector,y)
     y.assemble()
     return y.getArray()
@@ -297,40 +709,274 @@ def update(v, v_values):
     Update the nodal values in every dof of the DOLFIN function `v`
     according to `v_values`.
     -------------------------
-    v: dolfin function
+    v: dolfin function or constant
     v_values: numpy array
     """
-    if len(v_values) == 1:
+    if isinstance(v, Constant):
+        v.value = np.reshape(v_values, v.value.shape)
+    elif len(v_values) == 1:
         v.vector.set(v_values)
     else:
         setFuncArray(v, v_values)
 
 def computePartials(form, function):
+    if isinstance(function, Constant):
+        return computeConstantPartials(form, function)
     return derivative(form, function)
 
+def computeConstantPartials(form, constant):
+    """
+    Compute the partial derivative of the form w.r.t. the scalar constant,
+    by differentiating w.r.t. a UFL variable wrapping the constant
+    """
+    variable = ufl.variable(constant)
+    return ufl.diff(ufl.replace(form, {constant: variable}), variable)
+
 def createFunction(function):
     return Function(function.function_space)
 
-def solveNonlinear(res, func, bc, solver, report):
+def isAffine(F, u):
+    """
+    Check if the form `F` is affine in the function `u`, i.e. its
+    Jacobian w.r.t. `u` does not depend on `u`; the second derivative
+    is not used since it also vanishes for the piecewise nonlinear
+    residuals, e.g. with `conditional` or `abs` of `u`
+    """
+    dF_du = ufl.algorithms.expand_derivatives(derivative(F, u))
+    return u not in dF_du.coefficients()
+
+class LinearStateSolver(object):
+    """
+    Solve the problem F(w)=0 with F affine in w by a single linear solve,
+    w <- w - dF/dw^{-1} F(w), in place of the Newton iterations; the
+    Jacobian matrix, residual vector and KSP are created once, with the
+    linear solver from the solver spec `options` (MUMPS LU by default)
+    """
+    def __init__(self, F, w, bcs=[], options=None, prefix=None):
+        V = w.function_space
+        self.L = compileForm(F)
+        self.a = compileForm(derivative(F, w, TrialFunction(V)))
+        self.bcs = bcs
+        self.A = create_matrix(self.a)
+        self.b = la.create_petsc_vector(V.dofmap.index_map,
+                                        V.dofmap.index_map_bs)
+        self.dw = self.A.createVecRight()
+        attachNearNullspace(self.A, V, options)
+        if prefix is None:
+            prefix = uniqueOptionsPrefix('linear_state')
+        self.krylov_solver = PETSc.KSP().create(self.A.getComm())
+        self.krylov_solver.setOperators(self.A)
+        configureKSP(self.krylov_solver, options, prefix, V)
+
+    def solve(self, w):
+        self.A.zeroEntries()
+        assemble_matrix(self.A, self.a, bcs=self.bcs)
+        self.A.assemble()
+
+        # Same lifting of the BCs as in the Newton solvers
+        x = w.vector
+        with self.b.localForm() as b_local:
+            b_local.set(0.0)
+        assemble_vector(self.b, self.L)
+        apply_lifting(self.b, [self.a], bcs=[self.bcs], x0=[x], scale=-1.0)
+        self.b.ghostUpdate(addv=PETSc.InsertMode.ADD,
+                            mode=PETSc.ScatterMode.REVERSE)
+        set_bc(self.b, self.bcs, x, -1.0)
+
+        # The KSP may have been handed over to the derivative solves;
+        # always factorize the freshly assembled operator
+        self.krylov_solver.setOperators(self.A)
+        self.krylov_solver.setReusePreconditioner(False)
+        self.krylov_solver.solve(self.b, self.dw)
+        x.axpy(-1.0, self.dw)
+        x.ghostUpdate(addv=PETSc.InsertMode.INSERT,
+                        mode=PETSc.ScatterMode.FORWARD)
+
+def createNonlinearSolver(res, func, bc, solver, report,
+                            options=None, prefix=None):
+    """
+    Create the Newton or SNES solver of the nonlinear problem res(func)=0,
+    or the `LinearStateSolver` for the solver type 'Linear'; it only
+    refers to the values of `func` and of the coefficients of `res`, so
+    it can be reused for all of the later solves of the problem
+    """
+    if solver == 'Linear':
+        return LinearStateSolver(res, func, bc,
+                            options=options, prefix=prefix)
+    elif solver == 'Newton':
+        return NewtonSolver(res, func, bc, report=report,
+                            options=options, prefix=prefix)
+    elif solver == 'SNES':
+        return SNESSolver(res, func, bc, report=report,
+                            options=options, prefix=prefix)
+    raise ValueError('unknown nonlinear solver '+str(solver))
+
+def solveNonlinear(res, func, bc, solver, report, options=None, prefix=None,
+                    nonlinear_solver=None):
+    """
+    Solve the nonlinear problem res(func)=0, with the given
+    `nonlinear_solver` from `createNonlinearSolver` or a new one, and
+    return the linear solver (KSP) of the last Newton iteration, which
+    holds the factorization of the Jacobian next to the solution
+    """
     from timeit import default_timer
     start = default_timer()
-    if solver == 'Newton':
-        newton_solver = NewtonSolver(res, func, bc, report=report)
+    if nonlinear_solver is None:
+        nonlinear_solver = createNonlinearSolver(res, func, bc, solver,
+                                    report, options=options, prefix=prefix)
+    ksp = getNonlinearKSP(nonlinear_solver)
+    # Every Newton iteration refactorizes its own Jacobian
+    ksp.setReusePreconditioner(False)
+    if solver == 'Linear':
+        nonlinear_solver.solve(func)
+    elif solver == 'Newton':
+        newton_solver = nonlinear_solver
         newton_solver.solve(func)
     elif solver == 'SNES':
-        snes_solver = SNESSolver(res, func, bc, report=report)
+        snes_solver = nonlinear_solver
         snes_solver.solve(None, func.vector)
         print("Converged reason:", snes_solver.getConvergedReason())
     stop = default_timer()
     if report is True:
         print("Solve nonlinear finished in ",stop-start, "seconds")
+    return ksp
+
+def getNonlinearKSP(nonlinear_solver):
+    """
+    Get the linear solver (KSP) of the solver from `createNonlinearSolver`
+    """
+    if isinstance(nonlinear_solver, PETSc.SNES):
+        return nonlinear_solver.getKSP()
+    return nonlinear_solver.krylov_solver
+
+def runNonlinearSolver(nonlinear_solver, func):
+    """
+    Run the solver from `createNonlinearSolver` on the state `func` and
+    return whether it converged and the number of Newton iterations
+    """
+    getNonlinearKSP(nonlinear_solver).setReusePreconditioner(False)
+    if isinstance(nonlinear_solver, LinearStateSolver):
+        nonlinear_solver.solve(func)
+        return True, 1
+    elif isinstance(nonlinear_solver, PETSc.SNES):
+        nonlinear_solver.solve(None, func.vector)
+        return (nonlinear_solver.getConvergedReason() > 0,
+                nonlinear_solver.getIterationNumber())
+    else:
+        iterations, converged = nonlinear_solver.solve(func)
+        return converged, iterations
+
+def getNonlinearTolerances(nonlinear_solver):
+    """
+    Get the absolute and relative tolerances and the maximum number of
+    iterations of the Newton or SNES solver
+    """
+    if isinstance(nonlinear_solver, PETSc.SNES):
+        rtol, atol, _, max_it = nonlinear_solver.getTolerances()
+        return atol, rtol, max_it
+    return (nonlinear_solver.atol, nonlinear_solver.rtol,
+            nonlinear_solver.max_it)
+
+def setNonlinearTolerances(nonlinear_solver, atol, rtol, max_it):
+    """
+    Set the absolute and relative tolerances and the maximum number of
+    iterations of the Newton or SNES solver
+    """
+    if isinstance(nonlinear_solver, PETSc.SNES):
+        nonlinear_solver.setTolerances(atol=atol, rtol=rtol, max_it=max_it)
+    else:
+        nonlinear_solver.atol = atol
+        nonlinear_solver.rtol = rtol
+        nonlinear_solver.max_it = max_it
+
+def solveContinuation(nonlinear_solver, func, load_factor,
+                        initial_step=0.2, min_step=1e-3, max_step=1.,
+                        target_iterations=5, growth=2., shrink=0.5,
+                        max_steps=100, atol=1e-10, rtol=1e-8, max_it=25,
+                        report=False):
+    """
+    Solve a hard nonlinear problem by continuation in the load factor
+    from 0 to 1, reusing the same (compiled) residual form and solver for
+    all of the steps. The step of the load factor grows after the steps
+    that take fewer than `target_iterations` Newton iterations, shrinks
+    after the slower ones, and a step that fails to converge is retried
+    from the last converged state with a smaller step.
+    -------------------------
+    nonlinear_solver: the solver from `createNonlinearSolver` or
+        `FEA.getNonlinearSolver`
+    func: the state function
+    load_factor: the Constant in the residual form that scales the load,
+        or a function that sets the load for a given load factor
+    atol, rtol, max_it: the tolerances of the solves of the steps, which
+        replace those of the solver until the continuation returns
+    Returns whether the full load was reached and the number of solves;
+    on failure (a step that does not converge with `min_step`, or more
+    than `max_steps` solves), `func` is left at the last converged state.
+    """
+    def setLoadFactor(value):
+        if isinstance(load_factor, Constant):
+            load_factor.value = value
+        else:
+            load_factor(value)
+
+    # The default tolerances of `NewtonSolver` only run a fixed number
+    # of iterations, which never report convergence
+    tolerances = None
+    if not isinstance(nonlinear_solver, LinearStateSolver):
+        tolerances = getNonlinearTolerances(nonlinear_solver)
+        setNonlinearTolerances(nonlinear_solver, atol, rtol, max_it)
+    current = 0.
+    step = min(initial_step, max_step)
+    num_solves = 0
+    previous_state = func.vector.copy()
+    converged = True
+    try:
+        while current < 1.:
+            if num_solves >= max_steps:
+                if report is True:
+                    print(" FEA: continuation stopped at load factor",
+                            current, "after", num_solves, "solves")
+                converged = False
+                break
+            trial = min(current+step, 1.)
+            setLoadFactor(trial)
+            step_converged, iterations = runNonlinearSolver(
+                                                nonlinear_solver, func)
+            num_solves += 1
+            if report is True:
+                print(" FEA: continuation step to load factor", trial,
+                        "converged" if step_converged else "failed",
+                        "in", iterations, "iterations")
+            if not step_converged:
+                # Retry from the last converged state with a smaller step
+                previous_state.copy(func.vector)
+                func.vector.ghostUpdate(addv=PETSc.InsertMode.INSERT,
+                                        mode=PETSc.ScatterMode.FORWARD)
+                setLoadFactor(current)
+                if step <= min_step:
+                    if report is True:
+                        print(" FEA: continuation failed at load factor",
+                                trial, "with the minimum step", min_step)
+                    converged = False
+                    break
+                step = max(step*shrink, min_step)
+                continue
+            current = trial
+            func.vector.copy(previous_state)
+            if iterations < target_iterations:
+                step = min(step*growth, max_step)
+            elif iterations > target_iterations:
+                step = max(step*shrink, min_step)
+    finally:
+        if tolerances is not None:
+            setNonlinearTolerances(nonlinear_solver, *tolerances)
+    return converged, num_solves
 
-import ufl
 class NonlinearSNESProblem:
 
     def __init__(self, F, u, bcs,
                  J=None):
-        self.L = form(F)
+        self.L = compileForm(F)
 
         # Create the Jacobian matrix, dF/du
         if J is None:
@@ -338,7 +984,7 @@ class NonlinearSNESProblem:
             du = TrialFunction(V)
             J = derivative(F, u, du)
 
-        self.a = form(J)
+        self.a = compileForm(J)
         self.bcs = bcs
         self.u = u
 
@@ -370,9 +1016,14 @@ def SNESSolver(F, w, bcs=[],
                     abs_tol=1e-13,
                     rel_tol=1e-13,
                     max_it=100,
-                    report=False):
+                    report=False,
+                    options=None,
+                    prefix=None):
     """
     https://github.com/FEniCS/dolfinx/blob/main/python/test/unit/nls/test_newton.py#L182-L205
+    The linear solver is set up from the solver spec `options`
+    (MUMPS LU by default); all of the settings go under the options
+    prefix `prefix`, so they do not leak to the other solvers
     """
     # Create nonlinear problem
 
@@ -381,9 +1032,13 @@ def SNESSolver(F, w, bcs=[],
     W = w.function_space
     b = la.create_petsc_vector(W.dofmap.index_map, W.dofmap.index_map_bs)
     J = create_matrix(problem.a)
+    attachNearNullspace(J, W, options)
     # Create Newton solver and solve
+    if prefix is None:
+        prefix = uniqueOptionsPrefix('snes')
     snes = PETSc.SNES().create()
-    opts = PETSc.Options()
+    snes.setOptionsPrefix(prefix)
+    opts = PETSc.Options(prefix)
     opts['snes_type'] = 'newtonls'
     opts['snes_linesearch_type'] = 'basic'
     # Ru: the choice of damping parameter seems to be mesh dependent;
@@ -395,10 +1050,8 @@ def SNESSolver(F, w, bcs=[],
         opts['snes_monitor'] = None
         opts['snes_linesearch_monitor'] = None
     snes.setTolerances(atol=abs_tol, rtol=rel_tol, max_it=max_it)
-    snes.getKSP().setType("preonly")
     snes.getKSP().setTolerances(atol=abs_tol,rtol=rel_tol)
-    snes.getKSP().getPC().setType("lu")
-    snes.getKSP().getPC().setFactorSolverType('mumps')
+    configureKSP(snes.getKSP(), options, prefix, W)
 
 
     snes.setFunction(problem.F, b)
@@ -414,11 +1067,14 @@ def NewtonSolver(F, w, bcs=[],
                     rel_tol=1e-30,
                     max_it=3,
                     error_on_nonconvergence=False,
-                    report=False):
+                    report=False,
+                    options=None,
+                    prefix=None):
 
     """
     Wrap up the nonlinear solver for the problem F(w)=0 and
-    returns the solution
+    returns the solution; the linear solver is set up from the solver
+    spec `options` (MUMPS LU by default) under the options prefix `prefix`
     """
     problem = NonlinearProblem(F, w, bcs)
     # Set the initial guess of the solution
@@ -434,14 +1090,17 @@ def NewtonSolver(F, w, bcs=[],
     solver.rtol = rel_tol
     solver.max_it = max_it
     solver.error_on_nonconvergence = error_on_nonconvergence
-    opts = PETSc.Options()
-    opts["nls_solve_pc_factor_mat_solver_type"] = "mumps"
+    if prefix is None:
+        prefix = uniqueOptionsPrefix('nls')
+    configureKSP(solver.krylov_solver, options, prefix, w.function_space)
+    attachNearNullspace(solver._A, w.function_space, options)
 
     return solver
 
-def solveKSP(A, b, x):
+def solveKSP(A, b, x, transpose=False):
     """
-    Wrap up the KSP solver for the linear system Ax=b
+    Wrap up the KSP solver for the linear system Ax=b, or A^T x=b
+    with `transpose=True` (without forming A^T)
     """
     ######### Set up the KSP solver ###############
 
@@ -461,12 +1120,16 @@ def solveKSP(A, b, x):
     localKSP.setTolerances(1.0e-12)
     #ksp.setGMRESRestart(30)
     ksp.setConvergenceHistory()
-    ksp.solve(b, x)
+    if transpose:
+        ksp.solveTranspose(b, x)
+    else:
+        ksp.solve(b, x)
     history = ksp.getConvergenceHistory()
 
-def solveKSP_mumps(A, b, x):
+def solveKSP_mumps(A, b, x, transpose=False):
     """
-    Implementation of KSP solution of the linear system Ax=b using MUMPS
+    Implementation of KSP solution of the linear system Ax=b using MUMPS;
+    A^T x=b is solved with the same factors for `transpose=True`
     """
 
     # setup petsc for pre-only solve
@@ -481,7 +1144,496 @@ def solveKSP_mumps(A, b, x):
 
     # solve
     ksp.setUp()
-    ksp.solve(b, x)
+    if transpose:
+        ksp.solveTranspose(b, x)
+    else:
+        ksp.solve(b, x)
+
+# The default solver spec of the nonlinear solvers
+DIRECT_SOLVER = dict(ksp_type='preonly', pc_type='lu',
+                        factor_solver_type='mumps')
+# The default solver spec of the derivative solves, as in `solveKSP`
+ASM_SOLVER = dict(ksp_type='gmres', pc_type='asm',
+                    options=dict(sub_ksp_type='gmres', sub_pc_type='lu',
+                                    sub_ksp_rtol=1.0e-12))
+
+_options_prefix_count = itertools.count()
+def uniqueOptionsPrefix(name):
+    """
+    Generate a PETSc options prefix that is not used by any other solver
+    """
+    return name+'_'+str(next(_options_prefix_count))+'_'
+
+# The keys of the solver specs that are not PETSc options
+SOLVER_SPEC_KEYS = ['prefix', 'warm_start', 'max_pc_lag',
+                    'pc_rebuild_iterations', 'scipy_threshold',
+                    'near_nullspace']
+
+def mergeSolverOptions(defaults, options):
+    """
+    Merge the solver spec `options` over the spec `defaults`, without the
+    keys that are not PETSc options; the solver and preconditioner of
+    the defaults are dropped if `options` sets its own `pc_type`
+    """
+    merged = dict(defaults)
+    if options is None:
+        return merged
+    if 'pc_type' in options:
+        for key in ['ksp_type', 'pc_type', 'factor_solver_type', 'options']:
+            merged.pop(key, None)
+    merged_options = dict(merged.get('options', dict()))
+    merged_options.update(options.get('options', dict()))
+    merged.update({key: value for key, value in options.items()
+                    if key not in SOLVER_SPEC_KEYS})
+    merged['options'] = merged_options
+    return merged
+
+def configureKSP(ksp, options, prefix, function_space=None,
+                    defaults=DIRECT_SOLVER):
+    """
+    Set up the KSP solver from the solver spec `options` merged over
+    `defaults` (see the README), under the options prefix `prefix`
+    """
+    options = mergeSolverOptions(defaults, options)
+    setKSPOptions(PETSc.Options(prefix), options)
+    ksp.setOptionsPrefix(prefix)
+    if options.get('pc_type') == 'fieldsplit':
+        setFieldsplit(ksp.getPC(), function_space, options, prefix)
+    ksp.setFromOptions()
+
+def setKSPOptions(opts, options):
+    """
+    Write the solver spec `options` into the PETSc options `opts`
+    """
+    if 'ksp_type' in options:
+        opts['ksp_type'] = options['ksp_type']
+    if 'pc_type' in options:
+        opts['pc_type'] = options['pc_type']
+    if 'factor_solver_type' in options:
+        opts['pc_factor_mat_solver_type'] = options['factor_solver_type']
+    if 'rtol' in options:
+        opts['ksp_rtol'] = options['rtol']
+    if 'atol' in options:
+        opts['ksp_atol'] = options['atol']
+    if 'max_it' in options:
+        opts['ksp_max_it'] = options['max_it']
+    if 'fieldsplit_type' in options:
+        opts['pc_fieldsplit_type'] = options['fieldsplit_type']
+    for key, value in options.get('options', dict()).items():
+        opts[key] = value
+
+def createFieldsplitIS(W):
+    """
+    Create the index sets of the owned dofs of each sub-space of the
+    mixed function space `W`, in the global numbering of the matrices
+    """
+    index_map = W.dofmap.index_map
+    bs = W.dofmap.index_map_bs
+    size_local = index_map.size_local*bs
+    offset = index_map.local_range[0]*bs
+    is_list = []
+    for i in range(W.num_sub_spaces):
+        _, dofs = W.sub(i).collapse()
+        dofs = np.asarray(dofs, dtype=np.int32)
+        owned_dofs = dofs[dofs < size_local] + offset
+        is_list.append(PETSc.IS().createGeneral(owned_dofs.astype(np.int32),
+                                                comm=W.mesh.comm))
+    return is_list
+
+def setFieldsplit(pc, W, options, prefix):
+    """
+    Set up the block preconditioner over the sub-spaces of the mixed
+    function space `W`, with the block solvers from `options['fields']`
+    """
+    if W is None or W.num_sub_spaces == 0:
+        raise ValueError('fieldsplit needs a mixed function space')
+    pc.setType('fieldsplit')
+    is_list = createFieldsplitIS(W)
+    pc.setFieldSplitIS(*[(str(i), is_i) for i, is_i in enumerate(is_list)])
+    for i, field_options in enumerate(options.get('fields', [])):
+        setKSPOptions(PETSc.Options(prefix+'fieldsplit_'+str(i)+'_'),
+                        field_options)
+
+def buildNearNullspace(V):
+    """
+    Build the rigid body modes of the vector function space `V` as the
+    near-nullspace for the algebraic multigrid preconditioners
+    """
+    gdim = V.mesh.geometry.dim
+    index_map = V.dofmap.index_map
+    bs = V.dofmap.index_map_bs
+    num_modes = 3 if gdim == 2 else 6
+    ns = [la.create_petsc_vector(index_map, bs) for i in range(num_modes)]
+    with ExitStack() as stack:
+        vec_local = [stack.enter_context(x.localForm()) for x in ns]
+        basis = [np.asarray(x) for x in vec_local]
+        # translations
+        dofs = [V.sub(i).dofmap.list.array for i in range(gdim)]
+        for i in range(gdim):
+            basis[i][dofs[i]] = 1.0
+        # rotations
+        x = V.tabulate_dof_coordinates()
+        dofs_block = V.dofmap.list.array
+        x0, x1, x2 = x[dofs_block, 0], x[dofs_block, 1], x[dofs_block, 2]
+        if gdim == 2:
+            basis[2][dofs[0]] = -x1
+            basis[2][dofs[1]] = x0
+        else:
+            basis[3][dofs[0]] = -x1
+            basis[3][dofs[1]] = x0
+            basis[4][dofs[0]] = x2
+            basis[4][dofs[2]] = -x0
+            basis[5][dofs[2]] = x1
+            basis[5][dofs[1]] = -x2
+    la.orthonormalize(ns)
+    return PETSc.NullSpace().create(vectors=ns)
+
+def attachNearNullspace(A, V, options):
+    """
+    Attach the rigid body modes to the matrix `A` when the solver spec
+    `options` uses algebraic multigrid on a displacement-like vector
+    function space `V`
+    """
+    if options is None or options.get('near_nullspace') is False:
+        return
+    if options.get('pc_type') not in ['gamg', 'hypre', 'ml']:
+        return
+    gdim = V.mesh.geometry.dim
+    if V.dofmap.index_map_bs != gdim or V.num_sub_spaces != gdim:
+        return
+    A.setNearNullSpace(buildNearNullspace(V))
+
+class HandoverPC(object):
+    """
+    Python context of a shell PC that applies the set-up preconditioner
+    `pc` of another KSP without changing it
+    """
+    def __init__(self):
+        self.pc = None
+
+    def apply(self, shell_pc, x, y):
+        self.pc.apply(x, y)
+
+    def applyTranspose(self, shell_pc, x, y):
+        self.pc.applyTranspose(x, y)
+
+def isDirectKSP(ksp):
+    """
+    Check if the KSP solves exactly with the factors of its operator
+    """
+    return (ksp.getType() == PETSc.KSP.Type.PREONLY
+            and ksp.getPC().getType() in ['lu', 'cholesky'])
+
+def createHandoverPC(comm):
+    pc = PETSc.PC().create(comm)
+    pc.setType(PETSc.PC.Type.PYTHON)
+    pc.setPythonContext(HandoverPC())
+    return pc
+
+class LinearSolver(object):
+    """
+    Keep the KSP solver of one linearization, so that its preconditioner
+    is set up once and reused by the forward and adjoint (transpose)
+    solves; see the README for the solver spec `options`
+    """
+    def __init__(self, A=None, options=None, prefix=None,
+                    function_space=None, warm_start=False,
+                    max_pc_lag=0, pc_rebuild_iterations=50):
+        self.A = None
+        self.ksp = None
+        self.options = options
+        self.prefix = prefix
+        self.function_space = function_space
+        if prefix is None:
+            self.prefix = uniqueOptionsPrefix('linear')
+        self.warm_start = warm_start
+        self.initial_guesses = dict()
+        self.cold_iterations = dict()
+        self.call_count = dict(fwd=0, rev=0)
+        self.num_linearizations = 0
+        self.num_solves = 0
+        self.num_iterations = 0
+        self.num_iterations_saved = 0
+        self.max_pc_lag = max_pc_lag
+        self.pc_rebuild_iterations = pc_rebuild_iterations
+        self.pc_lag = 0
+        self.pc_rebuild = True
+        self.num_pc_setups = 0
+        self.own_pc = None
+        self.handover_pc = None
+        self.num_pc_handovers = 0
+        if A is not None:
+            self.setOperator(A)
+
+    def createKSP(self, A):
+        # The KSP is only set up at its first solve, so that no
+        # factorization is computed when a Newton PC is handed over
+        ksp = PETSc.KSP().create(A.getComm())
+        ksp.setOperators(A)
+        configureKSP(ksp, self.options, self.prefix, self.function_space,
+                        defaults=ASM_SOLVER)
+        return ksp
+
+    def setOperator(self, A, ksp=None, exact=False):
+        """
+        Start a new linearization with the operator `A`; the preconditioner
+        is rebuilt at the next solve. The set-up preconditioner of another
+        `ksp` with an operator close to `A`, e.g. the last Newton solve of
+        the state, can be handed over to precondition the Krylov solves
+        with `A` instead; if the operator of `ksp` is `A` itself (`exact`,
+        e.g. the solve of a linear state) and `ksp` is a direct solver,
+        its factors also serve the direct solves.
+        """
+        self.A = A
+        if self.ksp is None:
+            self.ksp = self.createKSP(A)
+            self.own_pc = self.ksp.getPC()
+        self.call_count = dict(fwd=0, rev=0)
+        self.num_linearizations += 1
+
+        # A direct solve needs the factors of A itself
+        if ksp is not None and \
+                (self.ksp.getType() != PETSc.KSP.Type.PREONLY
+                    or (exact and isDirectKSP(ksp))):
+            # The handed-over PC is only applied through a shell PC, so
+            # its operators and reuse flag, which the nonlinear solver
+            # keeps using, are left untouched
+            if self.handover_pc is None:
+                self.handover_pc = createHandoverPC(A.getComm())
+            self.handover_pc.getPythonContext().pc = ksp.getPC()
+            self.ksp.setPC(self.handover_pc)
+            self.ksp.setOperators(A)
+            self.pc_rebuild = True
+            self.num_pc_handovers += 1
+            return
+        if self.handover_pc is not None:
+            self.handover_pc.getPythonContext().pc = None
+        if self.ksp.getPC() != self.own_pc:
+            self.ksp.setPC(self.own_pc)
+        self.ksp.setOperators(A)
+
+        # Keep the preconditioner of the previous linearization unless
+        # it is too old or has become too weak
+        lag = (self.max_pc_lag > 0 and not self.pc_rebuild
+                and self.pc_lag < self.max_pc_lag
+                and self.ksp.getType() != PETSc.KSP.Type.PREONLY)
+        if lag:
+            self.pc_lag += 1
+        else:
+            self.pc_lag = 0
+            self.num_pc_setups += 1
+        self.pc_rebuild = False
+        self.ksp.setReusePreconditioner(lag)
+
+    def solve(self, b, x):
+        """
+        Solve the linear system Ax=b
+        """
+        self.solveWithGuess(b, x, 'fwd')
+
+    def solveTranspose(self, b, x):
+        """
+        Solve the linear system A^T x=b
+        """
+        self.solveWithGuess(b, x, 'rev')
+
+    def solveWithGuess(self, b, x, mode):
+        # The warm starts reuse the solution of the same call number and
+        # mode at the previous linearization
+        key = (mode, self.call_count[mode])
+        self.call_count[mode] += 1
+        # a direct solve does not take an initial guess
+        warm_start = (self.warm_start
+                        and self.ksp.getType() != PETSc.KSP.Type.PREONLY)
+        guess = self.initial_guesses.get(key) if warm_start else None
+        if guess is not None:
+            x.setArray(guess)
+        self.ksp.setInitialGuessNonzero(guess is not None)
+        if mode == 'fwd':
+            self.ksp.solve(b, x)
+        else:
+            self.ksp.solveTranspose(b, x)
+        iterations = self.ksp.getIterationNumber()
+        self.num_solves += 1
+        self.num_iterations += iterations
+        if self.max_pc_lag > 0 and iterations > self.pc_rebuild_iterations:
+            # the lagged preconditioner is rebuilt for the next solves
+            if self.pc_lag > 0:
+                self.ksp.setReusePreconditioner(False)
+                self.pc_lag = 0
+                self.num_pc_setups += 1
+            else:
+                self.pc_rebuild = True
+        if warm_start:
+            if guess is None:
+                self.cold_iterations[key] = iterations
+            else:
+                self.num_iterations_saved += max(
+                                self.cold_iterations[key] - iterations, 0)
+            self.initial_guesses[key] = x.getArray().copy()
+
+    def info(self):
+        return dict(linearizations=self.num_linearizations,
+                    pc_setups=self.num_pc_setups,
+                    pc_handovers=self.num_pc_handovers,
+                    solves=self.num_solves,
+                    iterations=self.num_iterations,
+                    iterations_saved=self.num_iterations_saved)
+
+    def solveBlock(self, B_array, transpose=False):
+        """
+        Solve AX=B, or A^T X=B, for the right-hand sides stacked as the rows
+        of `B_array` (num_rhs x local size) as one block solve with a dense
+        block of vectors, and return the solutions stacked the same way
+        """
+        B_array = np.atleast_2d(B_array)
+        num_rhs = B_array.shape[0]
+        if num_rhs == 1:
+            # A single right-hand side keeps the warm starts and the
+            # preconditioner checks of `solveWithGuess`
+            x, b = self.A.createVecs()
+            b.setArray(B_array[0])
+            x.set(0.0)
+            self.solveWithGuess(b, x, 'rev' if transpose else 'fwd')
+            return np.array(x.getArray()).reshape(1, -1)
+        comm = self.A.getComm()
+        B = PETSc.Mat().createDense([self.A.getSizes()[0],
+                                    (PETSc.DECIDE, num_rhs)],
+                                    comm=comm)
+        B.setUp()
+        B.getDenseArray()[:,:] = B_array.T
+        B.assemble()
+        X = B.duplicate()
+        solver = self.ksp.matSolveTranspose if transpose else self.ksp.matSolve
+        try:
+            solver(B, X)
+        except (AttributeError, PETSc.Error):
+            # Fall back to one solve per column for the PETSc builds
+            # without block (transpose) solves
+            x, b = self.A.createVecs()
+            for i in range(num_rhs):
+                b.setArray(B_array[i])
+                x.set(0.0)
+                if transpose:
+                    self.ksp.solveTranspose(b, x)
+                else:
+                    self.ksp.solve(b, x)
+                X.getDenseArray()[:,i] = x.getArray()
+        self.num_solves += num_rhs
+        X_array = np.array(X.getDenseArray()).T
+        B.destroy()
+        X.destroy()
+        return X_array
+
+from scipy.sparse.linalg import splu
+# The size below which the derivative solves use `ScipyLinearSolver`
+SCIPY_SOLVER_THRESHOLD = 5000
+
+class ScipyLinearSolver(object):
+    """
+    The serial fast path of `LinearSolver` for small problems: the
+    operator is converted to a SciPy CSR matrix and factorized with
+    `splu` once per linearization, and the forward, adjoint and block
+    solves are back-substitutions with the cached factors
+    """
+    def __init__(self, A=None):
+        self.A = None
+        self.lu = None
+        self.pc = None
+        self.warm_start = False
+        self.max_pc_lag = 0
+        self.num_linearizations = 0
+        self.num_pc_handovers = 0
+        self.num_solves = 0
+        if A is not None:
+            self.setOperator(A)
+
+    def setOperator(self, A, ksp=None, exact=False):
+        """
+        Start a new linearization with the operator `A`; the factorization
+        is computed at the next solve, unless a direct `ksp` with the
+        operator `A` itself (`exact`) is handed over, whose factors are
+        then used for all of the solves
+        """
+        self.A = A
+        self.lu = None
+        self.pc = None
+        if ksp is not None and exact and isDirectKSP(ksp):
+            self.pc = ksp.getPC()
+            self.num_pc_handovers += 1
+        self.num_linearizations += 1
+
+    def factorize(self):
+        if self.lu is None:
+            indptr, indices, values = self.A.getValuesCSR()
+            A_csr = csr_matrix((values, indices, indptr),
+                                shape=self.A.getSize())
+            self.lu = splu(A_csr.tocsc())
+        return self.lu
+
+    def solve(self, b, x):
+        """
+        Solve the linear system Ax=b
+        """
+        if self.pc is not None:
+            self.pc.apply(b, x)
+        else:
+            x.setArray(self.factorize().solve(b.getArray()))
+        self.num_solves += 1
+
+    def solveTranspose(self, b, x):
+        """
+        Solve the linear system A^T x=b
+        """
+        if self.pc is not None:
+            self.pc.applyTranspose(b, x)
+        else:
+            x.setArray(self.factorize().solve(b.getArray(), trans='T'))
+        self.num_solves += 1
+
+    def solveBlock(self, B_array, transpose=False):
+        """
+        Solve AX=B, or A^T X=B, for the right-hand sides stacked as the
+        rows of `B_array`
+        """
+        B_array = np.atleast_2d(B_array)
+        if self.pc is not None:
+            x, b = self.A.createVecs()
+            X_array = np.zeros_like(B_array)
+            for i in range(B_array.shape[0]):
+                b.setArray(B_array[i])
+                if transpose:
+                    self.solveTranspose(b, x)
+                else:
+                    self.solve(b, x)
+                X_array[i] = x.getArray()
+            return X_array
+        self.num_solves += B_array.shape[0]
+        trans = 'T' if transpose else 'N'
+        return self.factorize().solve(np.ascontiguousarray(B_array.T),
+                                        trans=trans).T
+
+    def info(self):
+        return dict(linearizations=self.num_linearizations,
+                    pc_setups=self.num_linearizations-self.num_pc_handovers,
+                    pc_handovers=self.num_pc_handovers,
+                    solves=self.num_solves,
+                    iterations=0,
+                    iterations_saved=0)
+
+def createLinearSolver(A, options=None, threshold=None, **kwargs):
+    """
+    Create the solver for the derivative solves with the operator `A`:
+    a `ScipyLinearSolver` for serial problems with fewer dofs than
+    `threshold` (`SCIPY_SOLVER_THRESHOLD` by default, or
+    `options['scipy_threshold']`), and a `LinearSolver` otherwise
+    """
+    if threshold is None:
+        threshold = (options or dict()).get('scipy_threshold',
+                                            SCIPY_SOLVER_THRESHOLD)
+    if A.getComm().getSize() == 1 and A.getSize()[0] < threshold:
+        return ScipyLinearSolver()
+    return LinearSolver(options=options, **kwargs)
 
 def move(mesh, u):
     x = mesh.geometry.x
@@ -507,6 +1659,46 @@ def meshSize(mesh):
 
 
 
+def createSubdomainFunction(subdomains_mf, values, function_space=None,
+                            default=0.):
+    """
+    Create the cell-wise (DG0) coefficient field from the subdomain-tagged
+    material data, to replace the sums of per-subdomain integrals
+    `c_i*f*dx(i)` in the forms by a single integral `c*f*dx`
+    --------------------------
+    subdomains_mf: DOLFINx MeshTags of the cells
+    values: dict {tag: value}, or function of the tag that returns the
+            value (or None for `default`) of the cells with the tag
+    function_space: DG0 (or vector DG0) space, scalar DG0 by default
+    default: value of the cells without tags, or with tags without values
+    """
+    if function_space is None:
+        function_space = FunctionSpace(subdomains_mf.mesh, ('DG', 0))
+    f = Function(function_space)
+    bs = function_space.dofmap.index_map_bs
+    f_array = f.x.array.reshape(-1, bs)
+    f_array[:] = default
+    cells = subdomains_mf.indices
+    tags = subdomains_mf.values
+    cell_dofs = function_space.dofmap.list.array[cells]
+    for tag in np.unique(tags):
+        if callable(values):
+            value = values(int(tag))
+        else:
+            value = values.get(int(tag))
+        if value is None:
+            continue
+        f_array[cell_dofs[tags == tag]] = value
+    f.x.scatter_forward()
+    return f
+
+def createSubdomainIndicator(subdomains_mf, tags):
+    """
+    Create the DG0 indicator field of the subdomains with the given tags
+    """
+    return createSubdomainFunction(subdomains_mf,
+                                    {int(tag): 1. for tag in tags})
+
 def project(v, target_func, bcs=[]):
 
     """
@@ -523,10 +1715,11 @@ def project(v, target_func, bcs=[]):
     a = inner(Pv, w) * dx
     L = inner(v, w) * dx
     # Assemble linear system
-    A = assemble_matrix(form(a), bcs)
+    a = compileForm(a)
+    A = assemble_matrix(a, bcs)
     A.assemble()
-    b = assemble_vector(form(L))
-    apply_lifting(b, [form(a)], [bcs])
+    b = assemble_vector(compileForm(L))
+    apply_lifting(b, [a], [bcs])
     b.ghostUpdate(addv=PETSc.InsertMode.ADD, mode=PETSc.ScatterMode.REVERSE)
     set_bc(b, bcs)
 
@@ -0,0 +1,39 @@
+import pytest
+pytest.importorskip('dolfinx')
+
+from fe_csdl_opt.fea.utils_dolfinx import *
+from dolfinx.fem import locate_dofs_topological
+
+
+def createOperator():
+    mesh = createUnitSquareMesh(6)
+    V = FunctionSpace(mesh, ('CG', 1))
+    u = TrialFunction(V)
+    v = TestFunction(V)
+    # Non-symmetric, so that the transpose solves are checked
+    a = inner(grad(u), grad(v))*dx + u.dx(0)*v*dx
+    facets = locate_entities_boundary(mesh, mesh.topology.dim-1,
+                            lambda x: np.isclose(x[0], 0.))
+    bcs = [dirichletbc(Function(V), locate_dofs_topological(V,
+                            mesh.topology.dim-1, facets))]
+    return assembleMatrix(a, bcs=bcs)
+
+
+@pytest.mark.parametrize('solver_type', ['petsc', 'scipy'])
+@pytest.mark.parametrize('num_rhs', [1, 3])
+def testAdjointSeedsAsOneBlock(solver_type, num_rhs):
+    A = createOperator()
+    if solver_type == 'petsc':
+        solver = LinearSolver(options=DIRECT_SOLVER)
+    else:
+        solver = ScipyLinearSolver()
+    solver.setOperator(A)
+
+    size = A.getSize()[0]
+    seeds = np.random.default_rng(0).random((num_rhs, size))
+    adjoints = solver.solveBlock(seeds, transpose=True)
+
+    A_dense = convertToDense(A)
+    assert adjoints.shape == (num_rhs, size)
+    assert np.allclose(adjoints, np.linalg.solve(A_dense.T, seeds.T).T)
+    assert solver.info()['solves'] == num_rhs
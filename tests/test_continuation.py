@@ -0,0 +1,28 @@
+import pytest
+pytest.importorskip('dolfinx')
+
+from fe_csdl_opt.fea.utils_dolfinx import *
+from dolfinx.fem import locate_dofs_topological
+
+
+def testContinuationWithDefaultNewtonSettings():
+    mesh = createUnitSquareMesh(8)
+    V = FunctionSpace(mesh, ('CG', 1))
+    u = Function(V)
+    v = TestFunction(V)
+    load_factor = Constant(mesh, PETSc.ScalarType(0.))
+    res = (1+u**2)*inner(grad(u), grad(v))*dx - load_factor*20.*v*dx
+    facets = locate_entities_boundary(mesh, mesh.topology.dim-1,
+                            lambda x: np.full(x.shape[1], True))
+    bcs = [dirichletbc(Function(V), locate_dofs_topological(V,
+                            mesh.topology.dim-1, facets))]
+    # The defaults of `NewtonSolver`, as used with PDE_SOLVER='Newton'
+    solver = createNonlinearSolver(res, u, bcs, 'Newton', False)
+    tolerances = getNonlinearTolerances(solver)
+
+    converged, num_solves = solveContinuation(solver, u, load_factor,
+                                                initial_step=0.25)
+    assert converged
+    assert np.isclose(load_factor.value, 1.)
+    assert computeResidualNorm(res, bcs) < 1e-6
+    assert getNonlinearTolerances(solver) == tolerances
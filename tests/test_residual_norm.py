@@ -0,0 +1,26 @@
+import pytest
+pytest.importorskip('dolfinx')
+
+from fe_csdl_opt.fea.utils_dolfinx import *
+from dolfinx.fem import locate_dofs_topological
+
+
+def testResidualNormExcludesDirichletDofs():
+    mesh = createUnitSquareMesh(4)
+    V = FunctionSpace(mesh, ('CG', 1))
+    u = Function(V)
+    u.interpolate(lambda x: 1. + x[0]*x[1])
+    v = TestFunction(V)
+    res = inner(grad(u), grad(v))*dx - u*v*dx
+    facets = locate_entities_boundary(mesh, mesh.topology.dim-1,
+                            lambda x: np.isclose(x[0], 0.))
+    bcs = [dirichletbc(Function(V), locate_dofs_topological(V,
+                            mesh.topology.dim-1, facets))]
+    dofs = getBCDofs(bcs)
+    assert len(dofs) > 0
+
+    b = assembleVector(res)
+    b[dofs] = 0.
+    norm = np.sqrt(comm.allreduce(np.dot(b, b)))
+    assert np.isclose(computeResidualNorm(res, bcs), norm)
+    assert computeResidualNorm(res, bcs) < computeResidualNorm(res)